@@ -1,4 +1,53 @@
 sudo python3 scripts/create_squash_backups.py sysdatanohome -cwd -c 1 
 
 # To check if the regex is properly working
-#sudo python3 scripts/create_squash_backups.py sysdatanohome -cwd -c 1 | grep docker
\ No newline at end of file
+#sudo python3 scripts/create_squash_backups.py sysdatanohome -cwd -c 1 | grep docker
+# Write phase timings and mksquashfs resource usage as json report and for the prometheus node_exporter textfile collector
+#sudo python3 scripts/create_squash_backups.py sysdatanohome -c 1 -md /backups/metrics -prom /var/lib/node_exporter/textfile_collector
+
+# Stream the home directory as tar archive compressed with multithreaded zstd (long distance matching) to another host
+#python3 scripts/create_squash_backups.py home -be tar_zstd -c 9 -pipe "ssh backuphost 'cat > /backups/home.tar.zst'"
+
+# Compare creation throughput, ratio and restore speed of the squashfs and tar+zstd backends
+#sudo python3 scripts/benchmark_backends.py /home/user/Documents -b /tmp/backend-bench -c 3 17
+
+# Create a blake2b checksum manifest of all backed up files next to the image (hashed while mksquashfs reads the tree)
+#sudo python3 scripts/create_squash_backups.py home -c 17 -mf -hw 4
+
+# Weekly verification of all images in /backups (crontab), at most 2 images at once and 200MB/s of reads
+#0 3 * * 0 python3 /opt/archiving-and-backup-scripts/scripts/verify_backups.py -b /backups -j 2 -r 200 -o /backups/verify_status.json
+
+# Show predicted duration and image size (from the recorded previous runs) without creating the image
+#sudo python3 scripts/create_squash_backups.py home -c 17 -dry
+#python3 scripts/run_history.py -b /backups
+
+# System backup of /etc, /srv, /usr/local and /var/lib with dpkg/apt, flatpak and snap package lists instead of the package payloads
+#sudo python3 scripts/create_squash_backups.py sys_packages -c 17
+# Reinstall the packages from a mounted sys_packages image
+#sudo python3 scripts/restore_packages.py /mnt/sys_packages_image -dry
+
+# Read files ahead of mksquashfs in physical disk order (for trees with many small files on HDDs)
+#sudo python3 scripts/create_squash_backups.py home -c 17 -ra -rw 512
+# Compare cold cache read throughput with and without the read ahead
+#sudo python3 scripts/benchmark_readahead.py /home/user -b /tmp/readahead-bench
+
+# Recompress images older than 7 days with zstd 22 (xz with x86 BCJ filter for system images) when the machine is idle
+#0 1 * * * sudo python3 /opt/archiving-and-backup-scripts/scripts/retier_backups.py -b /backups -a 7 -p zstd22 -sp xz_x86
+
+# Skip the backup if the stat fingerprint of the source did not change since the last image of the target
+#sudo python3 scripts/create_squash_backups.py sysdatanohome -c 17 -su
+
+# Keep images mounted through the mount pool (at most 4, least recently used are unmounted), mounting again reuses the mount
+#sudo python3 scripts/squashfs_mount.py mount /backups/home__home-01-01-2026-c_zstd-b_256k-l_17.squash.img -m 4
+#sudo python3 scripts/squashfs_mount.py list
+#sudo python3 scripts/squashfs_mount.py cleanup
+
+# Compact (memory mappable) listing of a source dir, look up entries in it
+#sudo python3 scripts/compact_manifest.py /home -e '... .cache' -o /backups/home.cmanifest
+#python3 scripts/compact_manifest.py /backups/home.cmanifest -f user/.bashrc
+# Memory and load time of the compact listing against a dict of tuples on a generated 20M entry tree
+#python3 scripts/benchmark_compact_manifest.py -n 20000000 -nn 2000000
+
+# What changed between two images of a target (or an image and the live source dir), json report for audits
+#sudo python3 scripts/diff_backups.py /backups/home__home-12-10-2026-c_zstd-b_256k-l_17.squash.img /backups/home__home-19-10-2026-c_zstd-b_256k-l_17.squash.img -o /tmp/home-diff.json
+#sudo python3 scripts/diff_backups.py /backups/home__home-19-10-2026-c_zstd-b_256k-l_17.squash.img /home -so -t home
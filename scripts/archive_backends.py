@@ -0,0 +1,282 @@
+import os
+from os.path import exists, join
+from datetime import date
+import re
+import subprocess
+from squashfs_mount import verify_squashfs
+from package_manifests import write_pseudo_definitions
+
+# The backends share the naming of the resulting images and the exclude lists of the targets (mksquashfs wildcard syntax)
+# but differ in how the archive is created, verified and restored
+
+
+def get_backup_target_path(source_dir, backups_dir, settings_string, extension, label_prefix=""):
+
+    if (not backups_dir):
+        backups_dir = "/backups"
+
+    if (backups_dir and not exists(backups_dir)):
+        os.makedirs(backups_dir, exist_ok=True)
+
+    if (not exists(source_dir)):
+        raise Exception(f"Source dir {source_dir} does not exist")
+
+
+    fs_source_path_label = source_dir.replace('/', '-')
+    if(source_dir.strip() == "/"):
+        fs_source_path_label = "system"
+
+    if(label_prefix != ""):
+        label_prefix = label_prefix +  '__'
+
+
+    today = date.today()
+    today_date_string = today.strftime("%d-%m-%Y")
+
+    full_backup_name = label_prefix + fs_source_path_label + "-" + today_date_string + "-" + settings_string + extension
+
+    if (full_backup_name[0] == '-'):
+        full_backup_name = full_backup_name[1:]
+
+    return join(backups_dir, full_backup_name)
+
+
+class ArchiveBackend():
+    name = None
+    extension = None
+
+    def get_settings_string(self, compression_lvl):
+        raise NotImplementedError()
+
+    def get_base_cmd(self, source_dir, backups_dir=None, compression_lvl=17, label_prefix=""):
+        """Returns the command creating the archive (without exclude options) and the path of the resulting image"""
+        raise NotImplementedError()
+
+    def get_filter_options(self, filters_arg):
+        raise NotImplementedError()
+
+    def get_full_cmd_args(self, base_cmd, filter_options, target_path, compression_lvl, generated_dir=None):
+        """generated_dir: directory of generated files (like package lists), that are added to the root of the image"""
+        return base_cmd + filter_options
+
+    def get_self_exclude(self, target_image_name):
+        return f"... {str(target_image_name)}"
+
+    def get_extract_cmd(self, image_path, target_dir):
+        raise NotImplementedError()
+
+    def verify(self, image_path, run_metrics=None):
+        raise NotImplementedError()
+
+
+class SquashfsBackend(ArchiveBackend):
+    name = 'squashfs'
+    extension = '.squash.img'
+
+    comp_algo = "zstd"
+    block_size = "256k"
+
+    def get_settings_string(self, compression_lvl):
+        return f"c_{self.comp_algo}-b_{self.block_size}-l_{compression_lvl}"
+
+    def get_base_cmd(self, source_dir, backups_dir=None, compression_lvl=17, label_prefix=""):
+        target_path = get_backup_target_path(source_dir, backups_dir, self.get_settings_string(compression_lvl), self.extension, label_prefix)
+
+        cmd = [
+            'sudo',
+            'mksquashfs',
+            source_dir,
+            target_path,
+            '-comp', self.comp_algo,
+            "-Xcompression-level", str(compression_lvl),
+            "-b", self.block_size,
+            "-mem", "1200M",
+            "-info", "-progress",
+            "-noappend"
+        ]
+
+        return cmd, target_path
+
+    def get_full_cmd_args(self, base_cmd, filter_options, target_path, compression_lvl, generated_dir=None):
+        if (not generated_dir):
+            return base_cmd + filter_options
+
+        # Pseudo files are generated by mksquashfs from the output of a command, without being part of the source dir
+        definitions_path = write_pseudo_definitions(generated_dir, generated_dir.rstrip('/') + '.pseudo')
+        return base_cmd + ['-pf', f"'{definitions_path}'"] + filter_options
+
+    def get_filter_options(self, filters_arg):
+
+        if (not filters_arg):
+            return []
+
+        #cmd = ['-regex']
+        cmd = ['-wildcards']
+
+        for filter in filters_arg:
+            cmd.append('-e')
+            cmd.append(f"'{filter}'")
+
+        return cmd
+
+    def get_extract_cmd(self, image_path, target_dir):
+        return ['sudo', 'unsquashfs', '-f', '-d', target_dir, image_path]
+
+    def verify(self, image_path, run_metrics=None):
+        return exists(image_path) and verify_squashfs(image_path, run_metrics)
+
+
+# Streams the source through tar into a multithreaded zstd process, which makes it possible to pipe the archive
+# to another host (no seekable target file is needed like with mksquashfs) and works without squashfs-tools
+# --long enables long distance matching, which finds redundancy between files further apart than the normal window
+# Note that images created with a window log above 27 also need '--long=<window log>' when decompressing
+class TarZstdBackend(ArchiveBackend):
+    name = 'tar_zstd'
+    extension = '.tar.zst'
+
+    def __init__(self, threads=0, long_window_log=27, stream_cmd=None):
+        # 0 threads lets zstd use one thread per physical core
+        self.threads = threads
+        self.long_window_log = long_window_log
+        # Shell command to pipe the archive into instead of writing it to the backups dir, e.g. "ssh host 'cat > /backups/home.tar.zst'"
+        self.stream_cmd = stream_cmd
+
+    def get_settings_string(self, compression_lvl):
+        return f"c_zstd-long_{self.long_window_log}-l_{compression_lvl}"
+
+    def get_zstd_options(self, compression_lvl=None):
+        options = [f"-T{self.threads}", f"--long={self.long_window_log}"]
+
+        if (compression_lvl):
+            # Levels above 19 are only allowed with --ultra
+            if (compression_lvl > 19):
+                options.append('--ultra')
+            options.append(f"-{compression_lvl}")
+
+        return options
+
+    def get_base_cmd(self, source_dir, backups_dir=None, compression_lvl=17, label_prefix=""):
+        target_path = get_backup_target_path(source_dir, backups_dir, self.get_settings_string(compression_lvl), self.extension, label_prefix)
+
+        # The exclude options need to come before the member list '.', which is added in get_full_cmd_args
+        cmd = [
+            'sudo',
+            'tar',
+            '--create',
+            '--file=-',
+            f"--directory='{source_dir}'",
+            '--xattrs',
+            '--acls',
+        ]
+
+        return cmd, target_path
+
+    def get_full_cmd_args(self, base_cmd, filter_options, target_path, compression_lvl, generated_dir=None):
+        members = ['.']
+        if (generated_dir):
+            # --directory only applies to the members following it
+            members += [f"--directory='{generated_dir}'"] + sorted(os.listdir(generated_dir))
+
+        # Exit status 1 of tar only means that files changed while they were read, which mksquashfs does not fail for either
+        archive_cmd = ['('] + base_cmd + filter_options + members + ['||', '[', '$?', '-eq', '1', ']', ')']
+        compress_cmd = ['|', 'zstd', '-q'] + self.get_zstd_options(compression_lvl)
+
+        if (self.stream_cmd):
+            compress_cmd += ['|', self.stream_cmd]
+        else:
+            compress_cmd += ['-f', '-o', f"'{target_path}'"]
+
+        return archive_cmd + compress_cmd
+
+    # Converts the mksquashfs wildcard excludes of the targets to GNU tar excludes
+    # 'path/in/source' is anchored to the root of the source dir, '... name' matches at any depth
+    def get_filter_options(self, filters_arg):
+
+        if (not filters_arg):
+            return []
+
+        cmd = ['--wildcards']
+
+        for filter in filters_arg:
+            if ('!(' in filter):
+                # mksquashfs extended wildcards (excluding everything but a match) have no tar equivalent
+                print(f"Skipping exclude '{filter}', extended wildcards are not supported by the tar backend")
+                continue
+
+            if (filter.startswith('... ')):
+                cmd.append('--no-anchored')
+                cmd.append(f"--exclude='{filter[4:]}'")
+            else:
+                cmd.append('--anchored')
+                cmd.append(f"--exclude='./{filter}'")
+
+        return cmd
+
+    def get_extract_cmd(self, image_path, target_dir):
+        return ['zstd', '-dc'] + self.get_zstd_options() + [f"'{image_path}'", '|', 'sudo', 'tar', '--extract', '--file=-', f"--directory='{target_dir}'"]
+
+    def verify(self, image_path, run_metrics=None):
+
+        if (self.stream_cmd):
+            print(f"Archive was streamed to '{self.stream_cmd}', can not verify it locally")
+            return True
+
+        if (not exists(image_path) or os.stat(image_path).st_size <= 0):
+            return False
+
+        # Checks the zstd frame checksums and that tar can read all headers, without writing anything to disk
+        list_cmd = f"zstd -dc {' '.join(self.get_zstd_options())} '{image_path}' | tar --list --file=-"
+        print(list_cmd)
+        # pipefail, otherwise a zstd error in the middle of the archive is hidden behind the status of tar
+        list_process = subprocess.run(['bash', '-o', 'pipefail', '-c', list_cmd], capture_output=True, text=True)
+
+        if (list_process.returncode != 0):
+            print(list_process.stderr)
+            return False
+
+        members = list_process.stdout.splitlines()
+        print(f"The archive contains {len(members)} entries")
+
+        return any(not member.endswith('/') for member in members)
+
+
+archive_backends = {
+    'squashfs': SquashfsBackend,
+    'squash': SquashfsBackend,
+    'tar_zstd': TarZstdBackend,
+    'tarzstd': TarZstdBackend,
+    'tar': TarZstdBackend,
+}
+
+
+def get_archive_backend(options):
+    backend_name = getattr(options, 'backend', None) or 'squashfs'
+
+    if (backend_name not in archive_backends):
+        raise Exception(f"Unknown archive backend '{backend_name}', available backends: {', '.join(archive_backends.keys())}")
+
+    backend_class = archive_backends[backend_name]
+
+    if (backend_class == TarZstdBackend):
+        return TarZstdBackend(threads=getattr(options, 'zstd_threads', 0), long_window_log=getattr(options, 'zstd_long', 27), stream_cmd=getattr(options, 'stream_cmd', None))
+
+    return backend_class()
+
+
+# The zstd window of a tar archive is part of its settings string, decompressing needs at least the same window
+tar_long_window_regex = re.compile(r'-long_(\d+)-')
+
+
+def get_backend_for_image(image_path):
+    for backend_class in set(archive_backends.values()):
+        if (not image_path.endswith(backend_class.extension)):
+            continue
+
+        if (backend_class == TarZstdBackend):
+            long_window_match = tar_long_window_regex.search(os.path.basename(image_path))
+            if (long_window_match):
+                return TarZstdBackend(long_window_log=int(long_window_match.group(1)))
+
+        return backend_class()
+
+    return None
@@ -0,0 +1,357 @@
+import os
+from os.path import join
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Sampling of the resource usage of child processes (mksquashfs and the shell/sudo wrapping it)
+# Everything is read from procfs, so this only yields data on linux
+# https://man7.org/linux/man-pages/man5/proc.5.html
+
+clock_ticks_per_second = os.sysconf('SC_CLK_TCK')
+
+metric_prefix = 'squash_backup'
+
+
+def read_proc_file(pid, name):
+    try:
+        with open(f"/proc/{pid}/{name}", 'r') as proc_file:
+            return proc_file.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        # Process already exited or belongs to another user (/proc/<pid>/io of a root process without sudo)
+        return None
+
+
+def parse_proc_stat(stat_text):
+    # The command name is in parentheses and can contain spaces, so split after the last ')'
+    # Fields after the name start with field 3 (state), see 'man 5 proc'
+    fields = stat_text[stat_text.rfind(')') + 2:].split()
+    return {
+        'ppid': int(fields[1]),
+        'utime': int(fields[11]),
+        'stime': int(fields[12]),
+    }
+
+
+def parse_proc_key_values(text, value_factor=1):
+    values = {}
+    for line in text.splitlines():
+        if (':' not in line):
+            continue
+        key, value = line.split(':', 1)
+        value_parts = value.split()
+        if (len(value_parts) <= 0 or not value_parts[0].isdigit()):
+            continue
+        values[key.strip()] = int(value_parts[0]) * value_factor
+
+    return values
+
+
+def get_child_pids_map():
+    children_map = {}
+    for entry in os.listdir('/proc'):
+        if (not entry.isdigit()):
+            continue
+
+        stat_text = read_proc_file(entry, 'stat')
+        if (not stat_text):
+            continue
+
+        ppid = parse_proc_stat(stat_text)['ppid']
+        children_map.setdefault(ppid, []).append(int(entry))
+
+    return children_map
+
+
+def get_process_tree_pids(root_pid):
+    children_map = get_child_pids_map()
+
+    tree_pids = []
+    pending = [root_pid]
+    while (len(pending) > 0):
+        pid = pending.pop()
+        tree_pids.append(pid)
+        pending += children_map.get(pid, [])
+
+    return tree_pids
+
+
+def sample_process(pid):
+    stat_text = read_proc_file(pid, 'stat')
+    if (not stat_text):
+        return None
+
+    stat = parse_proc_stat(stat_text)
+    sample = {
+        'cpu_seconds': (stat['utime'] + stat['stime']) / clock_ticks_per_second,
+        'rss_bytes': 0,
+        'peak_rss_bytes': 0,
+        'read_bytes': 0,
+        'write_bytes': 0,
+        'rchar': 0,
+        'wchar': 0,
+    }
+
+    status_text = read_proc_file(pid, 'status')
+    if (status_text):
+        # VmRSS and VmHWM are reported in kB
+        status = parse_proc_key_values(status_text, value_factor=1024)
+        sample['rss_bytes'] = status.get('VmRSS', 0)
+        sample['peak_rss_bytes'] = status.get('VmHWM', 0)
+
+    io_text = read_proc_file(pid, 'io')
+    if (io_text):
+        io = parse_proc_key_values(io_text)
+        for key in ['read_bytes', 'write_bytes', 'rchar', 'wchar']:
+            sample[key] = io.get(key, 0)
+
+    return sample
+
+
+def is_process_running(pid):
+    stat_text = read_proc_file(pid, 'stat')
+    # Exited processes stay as zombies (state Z) until they are waited for
+    return bool(stat_text) and stat_text[stat_text.rfind(')') + 2] not in 'ZX'
+
+
+def get_process_tree_read_position(root_pid):
+    """Bytes read so far by the process of the tree that read the most (rchar), None if the io counters of a process are not readable"""
+    # The maximum instead of the sum, as in pipelines like 'tar | zstd' every process reads the same data once
+    read_position = 0
+    for pid in get_process_tree_pids(root_pid):
+        if (not read_proc_file(pid, 'stat')):
+            continue
+
+        io_text = read_proc_file(pid, 'io')
+        if (not io_text):
+            # /proc/<pid>/io of processes of other users (sudo mksquashfs) is only readable by root
+            return None
+
+        read_position = max(read_position, parse_proc_key_values(io_text).get('rchar', 0))
+
+    return read_position
+
+
+class ProcessTreeSampler(threading.Thread):
+    """Periodically samples cpu, memory and io counters of a process and all of its descendants"""
+
+    def __init__(self, root_pid, interval=1.0):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.stop_event = threading.Event()
+        # Counters in /proc are cumulative per process, keep the last value of every pid that was seen
+        # so that the usage of processes that exited in between samples is not lost
+        self.last_samples = {}
+        self.peak_rss_bytes = 0
+        self.timeline = []
+        self.start_time = None
+
+    def sample(self):
+        current_rss_bytes = 0
+        for pid in get_process_tree_pids(self.root_pid):
+            process_sample = sample_process(pid)
+            if (not process_sample):
+                continue
+            self.last_samples[pid] = process_sample
+            current_rss_bytes += process_sample['rss_bytes']
+
+        self.peak_rss_bytes = max(self.peak_rss_bytes, current_rss_bytes)
+
+        totals = self.get_totals()
+        totals['elapsed_s'] = round(time.monotonic() - self.start_time, 3)
+        totals['rss_bytes'] = current_rss_bytes
+        self.timeline.append(totals)
+
+    def run(self):
+        self.start_time = time.monotonic()
+        while (not self.stop_event.is_set()):
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def get_totals(self):
+        totals = {
+            'cpu_seconds': 0.0,
+            'read_bytes': 0,
+            'write_bytes': 0,
+            'rchar': 0,
+            'wchar': 0,
+        }
+        peak_process_rss_bytes = 0
+        for process_sample in self.last_samples.values():
+            for key in totals:
+                totals[key] += process_sample[key]
+            peak_process_rss_bytes = max(peak_process_rss_bytes, process_sample['peak_rss_bytes'])
+
+        totals['cpu_seconds'] = round(totals['cpu_seconds'], 2)
+        totals['peak_rss_bytes'] = max(self.peak_rss_bytes, peak_process_rss_bytes)
+        totals['processes'] = len(self.last_samples)
+        return totals
+
+
+class RunMetrics():
+    """Collects phase durations and child process resource usage of one backup run"""
+
+    def __init__(self, target, source_dir, settings=None):
+        self.target = target
+        self.source_dir = source_dir
+        self.settings = settings or {}
+        self.start_timestamp = time.time()
+        self.phases = {}
+        self.processes = {}
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.monotonic()
+        try:
+            yield
+        finally:
+            # Phases can run more than once (for example mounting during verification), durations add up
+            self.phases[name] = self.phases.get(name, 0.0) + (time.monotonic() - phase_start)
+
+    def run_sampled(self, name, popen_factory, interval=1.0):
+        """Run the process created by 'popen_factory' as a timed phase, while sampling its process tree"""
+        with self.phase(name):
+            process = popen_factory()
+            sampler = ProcessTreeSampler(process.pid, interval=interval)
+            sampler.start()
+            try:
+                # wait4 also returns the accumulated usage of all reaped descendants, which covers
+                # the time between the last sample and the exit of mksquashfs
+                _, wait_status, rusage = os.wait4(process.pid, 0)
+                return_code = os.waitstatus_to_exitcode(wait_status)
+                process.returncode = return_code
+            finally:
+                sampler.stop()
+
+        process_totals = sampler.get_totals()
+        process_totals['cpu_seconds'] = round(max(process_totals['cpu_seconds'], rusage.ru_utime + rusage.ru_stime), 2)
+        # ru_maxrss is reported in kB
+        process_totals['peak_rss_bytes'] = max(process_totals['peak_rss_bytes'], rusage.ru_maxrss * 1024)
+        process_totals['return_code'] = return_code
+        process_totals['timeline'] = sampler.timeline
+        self.processes[name] = process_totals
+
+        return return_code
+
+    def set_value(self, key, value):
+        self.values[key] = value
+
+    def get_report(self):
+        report = {
+            'target': self.target,
+            'source_dir': self.source_dir,
+            'settings': self.settings,
+            'start_timestamp': self.start_timestamp,
+            'phases_s': {name: round(duration, 3) for name, duration in self.phases.items()},
+            'processes': self.processes,
+        }
+        report.update(self.values)
+
+        compression = self.processes.get('compression')
+        if (compression and self.phases.get('compression', 0) > 0):
+            # rchar also counts data served from the page cache, read_bytes only what hit the block device
+            report['read_throughput_bytes_per_s'] = round(compression['rchar'] / self.phases['compression'])
+
+        return report
+
+
+def timed_phase(run_metrics, name):
+    if (not run_metrics):
+        return nullcontext()
+
+    return run_metrics.phase(name)
+
+
+def write_file_atomic(file_path, content):
+    tmp_file_path = file_path + '.tmp'
+    with open(tmp_file_path, 'w') as out_file:
+        out_file.write(content)
+    os.replace(tmp_file_path, file_path)
+
+
+def write_json_report(run_metrics, metrics_dir):
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    run_time_string = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(run_metrics.start_timestamp))
+    report_path = join(metrics_dir, f"{run_metrics.target}-{run_time_string}.metrics.json")
+
+    write_file_atomic(report_path, json.dumps(run_metrics.get_report(), indent=4))
+    return report_path
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_prometheus_lines(run_metrics):
+    report = run_metrics.get_report()
+    target_label = f'target="{escape_label_value(run_metrics.target)}"'
+
+    metrics = [
+        ('last_run_timestamp_seconds', 'gauge', 'Start time of the last backup run', [(target_label, report['start_timestamp'])]),
+        ('phase_duration_seconds', 'gauge', 'Duration of the phases of the last backup run',
+            [(f'{target_label},phase="{escape_label_value(name)}"', duration) for name, duration in report['phases_s'].items()]),
+    ]
+
+    for key, help_text in [('success', 'Whether the last backup run succeeded (1) or failed (0)'),
+                           ('output_bytes', 'Size of the resulting image of the last backup run'),
+                           ('read_throughput_bytes_per_s', 'Bytes read per second by the compression process')]:
+        if (key in report):
+            metrics.append((key, 'gauge', help_text, [(target_label, int(report[key]))]))
+
+    process_metrics = [
+        ('cpu_seconds', 'child_cpu_seconds', 'Cpu time (user + system) used by the process tree of a phase'),
+        ('peak_rss_bytes', 'child_peak_rss_bytes', 'Peak resident memory of the process tree of a phase'),
+        ('read_bytes', 'child_read_bytes', 'Bytes read from storage by the process tree of a phase'),
+        ('write_bytes', 'child_write_bytes', 'Bytes written to storage by the process tree of a phase'),
+    ]
+    for key, name, help_text in process_metrics:
+        samples = [(f'{target_label},phase="{escape_label_value(phase)}"', totals[key]) for phase, totals in report['processes'].items()]
+        metrics.append((name, 'gauge', help_text, samples))
+
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        if (len(samples) <= 0):
+            continue
+        lines.append(f"# HELP {metric_prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {metric_prefix}_{name} {metric_type}")
+        for labels, value in samples:
+            lines.append(f"{metric_prefix}_{name}{{{labels}}} {value}")
+
+    return lines
+
+
+# Format for the node_exporter textfile collector: https://github.com/prometheus/node_exporter#textfile-collector
+# One file per target, so that the metrics of the last run of every target stay available
+def write_prometheus_textfile(run_metrics, textfile_dir):
+    os.makedirs(textfile_dir, exist_ok=True)
+
+    prom_path = join(textfile_dir, f"{metric_prefix}_{run_metrics.target}.prom")
+    write_file_atomic(prom_path, "\n".join(get_prometheus_lines(run_metrics)) + "\n")
+    return prom_path
+
+
+def print_phase_summary(run_metrics):
+    print("\nPhase durations:")
+    for name, duration in run_metrics.phases.items():
+        print(f"{name}: {round(duration, 2)}s")
+
+    for name, totals in run_metrics.processes.items():
+        print(f"{name} processes: cpu {totals['cpu_seconds']}s, peak rss {int(totals['peak_rss_bytes'] / pow(10, 6))}MB, read {int(totals['read_bytes'] / pow(10, 6))}MB, written {int(totals['write_bytes'] / pow(10, 6))}MB")
+
+
+def export_run_metrics(run_metrics, metrics_dir=None, textfile_dir=None):
+    print_phase_summary(run_metrics)
+
+    if (metrics_dir):
+        print(f"Wrote metrics report to {write_json_report(run_metrics, metrics_dir)}")
+
+    if (textfile_dir):
+        print(f"Wrote prometheus metrics to {write_prometheus_textfile(run_metrics, textfile_dir)}")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import isdir, exists, join
+import argparse
+import json
+import subprocess
+import sys
+from backup_metrics import RunMetrics
+from archive_backends import archive_backends, get_archive_backend
+from benchmark_mksquashfs import pretty_table, ugly_print
+
+# Creates an archive of the same source with each backend, then restores it again
+# to compare creation throughput, compression ratio and restore speed of the archive formats
+
+bench_table_keys = ['backend', 'level', 'create_s', 'create_MBps', 'cpu_s', 'output_MB', 'ratio', 'restore_s', 'restore_MBps']
+
+
+# Unlike get_dir_size of benchmark_mksquashfs this walks the whole tree (but still does not consider excludes)
+def get_tree_size(path):
+    tree_size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = join(dir_path, file_name)
+            if (not os.path.islink(file_path)):
+                tree_size += os.stat(file_path).st_size
+
+    return tree_size
+
+
+def to_mb(size_bytes):
+    return round(size_bytes / pow(10, 6), 2)
+
+
+def benchmark_backend(backend, source_dir, bench_dir, compression_lvl, exclude_filters, input_bytes):
+    run_metrics = RunMetrics(f"bench-{backend.name}", source_dir)
+
+    base_cmd, image_path = backend.get_base_cmd(source_dir, backups_dir=bench_dir, compression_lvl=compression_lvl, label_prefix=f"bench-{backend.name}")
+    filters = exclude_filters + [backend.get_self_exclude(os.path.basename(image_path))]
+    create_cmd = " ".join(backend.get_full_cmd_args(base_cmd, backend.get_filter_options(filters), image_path, compression_lvl))
+
+    print(create_cmd)
+    return_code = run_metrics.run_sampled('create', lambda: subprocess.Popen(['bash', '-o', 'pipefail', '-c', create_cmd]))
+
+    if (return_code != 0 or not exists(image_path)):
+        raise Exception(f"Benchmark of backend {backend.name} failed with return code {return_code}, image at path '{image_path}' was not created")
+
+    restore_dir = join(bench_dir, f"restore-{backend.name}")
+    os.makedirs(restore_dir, exist_ok=True)
+    restore_cmd = " ".join(backend.get_extract_cmd(image_path, restore_dir))
+
+    # Drop the image from the page cache, otherwise the restore speed is mostly a measure of decompression speed
+    os.system("sync && echo 1 | sudo tee /proc/sys/vm/drop_caches > /dev/null")
+
+    print(restore_cmd)
+    return_code = run_metrics.run_sampled('restore', lambda: subprocess.Popen(['bash', '-o', 'pipefail', '-c', restore_cmd]))
+    if (return_code != 0):
+        raise Exception(f"Benchmark of backend {backend.name} failed, restoring '{image_path}' returned {return_code}")
+
+    os.system(f"sudo rm -rf '{restore_dir}'")
+
+    output_bytes = os.stat(image_path).st_size
+    create_s = run_metrics.phases['create']
+    restore_s = run_metrics.phases['restore']
+
+    return {
+        'backend': backend.name,
+        'level': compression_lvl,
+        'image_path': image_path,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'create_s': round(create_s, 2),
+        'create_MBps': round(to_mb(input_bytes) / create_s, 2) if create_s > 0 else None,
+        'cpu_s': run_metrics.processes['create']['cpu_seconds'],
+        'output_MB': to_mb(output_bytes),
+        'ratio': round(output_bytes / input_bytes, 3) if input_bytes > 0 else None,
+        'restore_s': round(restore_s, 2),
+        'restore_MBps': round(to_mb(input_bytes) / restore_s, 2) if restore_s > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the archive backends on the same source directory (creation throughput, compression ratio, restore speed)"
+    )
+
+    parser.add_argument('source_dir', help="Source directory to archive with each backend")
+    parser.add_argument('-b', '--bench_dir', help="Directory to store the benchmark images and restores in (should not be inside the source dir)", default="/tmp/backend-bench")
+    parser.add_argument('-be', '--backends', nargs='+', choices=archive_backends.keys(), help="Backends to benchmark", default=['squashfs', 'tar_zstd'])
+    parser.add_argument('-c', '--compression_levels', '--compression', type=int, nargs='+', help="Compression levels to benchmark each backend with", default=[17])
+    parser.add_argument('-f', '--exclude_regex_filters', '--filters', nargs='+', help="Excludes (mksquashfs wildcard syntax) applied to all backends", default=[])
+    parser.add_argument('-zt', '--zstd_threads', type=int, help="Number of zstd compression threads of the tar backend (0 uses all cores)", default=0)
+    parser.add_argument('-zl', '--zstd_long', type=int, help="Window log of zstd long distance matching of the tar backend", default=27)
+    parser.add_argument('-k', '--keep_images', action="store_true", help="Do not delete the benchmark images afterwards")
+    parser.add_argument('-o', '--json_output', help="Path to write the benchmark results to as json", default=None)
+
+    args = parser.parse_args()
+
+    if (not isdir(args.source_dir)):
+        raise Exception(f"Source dir {args.source_dir} does not exist or is not a directory")
+
+    os.makedirs(args.bench_dir, exist_ok=True)
+
+    # Note that without considering the excludes the ratio and throughput are only accurate when no excludes are passed
+    input_bytes = get_tree_size(args.source_dir)
+    print(f"Size of source dir {args.source_dir}: {to_mb(input_bytes)}MB")
+
+    results = []
+    for backend_name in args.backends:
+        args.backend = backend_name
+        backend = get_archive_backend(args)
+
+        for compression_lvl in args.compression_levels:
+            result = benchmark_backend(backend, args.source_dir, args.bench_dir, compression_lvl, args.exclude_regex_filters, input_bytes)
+            results.append(result)
+
+            if (not args.keep_images):
+                os.remove(result['image_path'])
+
+    try:
+        pretty_table(sorted(results, key=lambda result: result['create_s']), bench_table_keys)
+    except ImportError:
+        ugly_print(results, bench_table_keys)
+
+    if (args.json_output):
+        with open(args.json_output, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
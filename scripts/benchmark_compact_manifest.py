@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import join
+import argparse
+import gc
+import json
+import random
+import stat
+import sys
+import time
+from backup_metrics import read_proc_file, parse_proc_key_values
+from benchmark_mksquashfs import pretty_table, ugly_print
+from compact_manifest import CompactManifest, CompactManifestBuilder
+
+# Compares memory use, load time and lookups of the compact manifest with a naive representation (dict of path -> tuple)
+# on a generated listing. The naive representation needs a few hundred bytes per entry, so by default it is only
+# built for a part of the entries and its memory is extrapolated to the full count
+
+manifest_table_keys = ['representation', 'entries', 'memory_MB', 'memory_MB_at_N', 'bytes_per_entry', 'build_s', 'file_MB', 'save_s', 'load_s', 'scan_s', 'lookup_us']
+
+
+def get_rss_bytes():
+    return parse_proc_key_values(read_proc_file('self', 'status'), 1024)['VmRSS']
+
+
+def get_subtree_entry_count(depth, dirs_per_dir, files_per_dir):
+    if (depth <= 0):
+        return files_per_dir
+    return files_per_dir + dirs_per_dir * (1 + get_subtree_entry_count(depth - 1, dirs_per_dir, files_per_dir))
+
+
+def generate_listing(entry_count, dirs_per_dir=10, files_per_dir=50, unique_name_fraction=0.1, seed=42):
+    """Yields (path components, size, mtime_ns, mode, ino) of a generated tree in tree order"""
+    randomizer = random.Random(seed)
+    depth = 0
+    while (get_subtree_entry_count(depth, dirs_per_dir, files_per_dir) < entry_count):
+        depth += 1
+
+    generated_count = 0
+    base_mtime_ns = 1700000000 * pow(10, 9)
+
+    def generate_dir(dir_components, remaining_depth):
+        nonlocal generated_count
+
+        children = []
+        if (remaining_depth > 0):
+            children += [(f"dir{index:02d}".encode(), True) for index in range(dirs_per_dir)]
+        for index in range(files_per_dir):
+            # Most file names repeat between directories (like in real trees), some are unique (hashes, dates, ...)
+            if (randomizer.random() < unique_name_fraction):
+                children.append((f"{randomizer.getrandbits(64):016x}.bin".encode(), False))
+            else:
+                children.append((f"file{index:03d}.dat".encode(), False))
+
+        for name, is_dir in sorted(set(children)):
+            if (generated_count >= entry_count):
+                return
+
+            generated_count += 1
+            components = dir_components + [name]
+            mtime_ns = base_mtime_ns + randomizer.getrandbits(40)
+            if (is_dir):
+                yield components, 4096, mtime_ns, stat.S_IFDIR | 0o755, generated_count
+                yield from generate_dir(components, remaining_depth - 1)
+            else:
+                yield components, randomizer.getrandbits(16), mtime_ns, stat.S_IFREG | 0o644, generated_count
+
+    yield from generate_dir([], depth)
+
+
+def benchmark_compact(listing_args, entry_count, bench_dir, lookup_paths):
+    gc.collect()
+    start_rss = get_rss_bytes()
+    start_time = time.monotonic()
+
+    builder = CompactManifestBuilder()
+    for components, size, mtime_ns, mode, ino in generate_listing(entry_count, **listing_args):
+        builder.add(components, size, mtime_ns, mode, ino)
+    compact_manifest = builder.finish('generated')
+    del builder
+
+    build_s = time.monotonic() - start_time
+    memory_bytes = get_rss_bytes() - start_rss
+
+    manifest_path = join(bench_dir, 'bench.cmanifest')
+    start_time = time.monotonic()
+    compact_manifest.save(manifest_path)
+    save_s = time.monotonic() - start_time
+    del compact_manifest
+    gc.collect()
+
+    start_time = time.monotonic()
+    compact_manifest = CompactManifest.load(manifest_path)
+    load_s = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    total_size = sum(compact_manifest.columns['size'])
+    scan_s = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    found_count = sum(1 for path in lookup_paths if compact_manifest.find(path) >= 0)
+    lookup_us = (time.monotonic() - start_time) / max(1, len(lookup_paths)) * pow(10, 6)
+
+    compact_manifest.close()
+    file_bytes = os.stat(manifest_path).st_size
+    os.remove(manifest_path)
+
+    print(f"Compact: {found_count}/{len(lookup_paths)} lookups found, total size {total_size}")
+
+    return {
+        'representation': 'compact (arrays)',
+        'entries': entry_count,
+        'memory_bytes': memory_bytes,
+        'build_s': build_s,
+        'file_bytes': file_bytes,
+        'save_s': save_s,
+        'load_s': load_s,
+        'scan_s': scan_s,
+        'lookup_us': lookup_us,
+    }
+
+
+def benchmark_naive(listing_args, entry_count, bench_dir, lookup_paths):
+    gc.collect()
+    start_rss = get_rss_bytes()
+    start_time = time.monotonic()
+
+    naive_manifest = {}
+    for components, size, mtime_ns, mode, ino in generate_listing(entry_count, **listing_args):
+        naive_manifest[os.fsdecode(b'/'.join(components))] = (size, mtime_ns, mode, ino)
+
+    build_s = time.monotonic() - start_time
+    memory_bytes = get_rss_bytes() - start_rss
+
+    # Text file like the checksum manifests
+    manifest_path = join(bench_dir, 'bench.tsv')
+    start_time = time.monotonic()
+    with open(manifest_path, 'w', encoding='utf-8', errors='surrogateescape') as manifest_file:
+        for path, (size, mtime_ns, mode, ino) in naive_manifest.items():
+            manifest_file.write(f"{size}\t{mtime_ns}\t{mode}\t{ino}\t{path}\n")
+    save_s = time.monotonic() - start_time
+    del naive_manifest
+    gc.collect()
+
+    start_time = time.monotonic()
+    naive_manifest = {}
+    with open(manifest_path, 'r', encoding='utf-8', errors='surrogateescape') as manifest_file:
+        for line in manifest_file:
+            size, mtime_ns, mode, ino, path = line.rstrip('\n').split('\t', 4)
+            naive_manifest[path] = (int(size), int(mtime_ns), int(mode), int(ino))
+    load_s = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    total_size = sum(entry[0] for entry in naive_manifest.values())
+    scan_s = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    found_count = sum(1 for path in lookup_paths if path in naive_manifest)
+    lookup_us = (time.monotonic() - start_time) / max(1, len(lookup_paths)) * pow(10, 6)
+
+    del naive_manifest
+    gc.collect()
+    file_bytes = os.stat(manifest_path).st_size
+    os.remove(manifest_path)
+
+    print(f"Naive: {found_count}/{len(lookup_paths)} lookups found, total size {total_size}")
+
+    return {
+        'representation': 'naive (dict of tuples)',
+        'entries': entry_count,
+        'memory_bytes': memory_bytes,
+        'build_s': build_s,
+        'file_bytes': file_bytes,
+        'save_s': save_s,
+        'load_s': load_s,
+        'scan_s': scan_s,
+        'lookup_us': lookup_us,
+    }
+
+
+def get_lookup_paths(listing_args, entry_count, lookup_count, seed=7):
+    # Reservoir sample over the generated listing, so the listing does not have to be kept in memory
+    randomizer = random.Random(seed)
+    sampled_paths = []
+    for index, (components, _, _, _, _) in enumerate(generate_listing(entry_count, **listing_args)):
+        if (index < lookup_count):
+            sampled_paths.append(os.fsdecode(b'/'.join(components)))
+        else:
+            replaced_index = randomizer.randrange(index + 1)
+            if (replaced_index < lookup_count):
+                sampled_paths[replaced_index] = os.fsdecode(b'/'.join(components))
+
+    return sampled_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark memory use and load time of the compact manifest against a naive representation on a generated tree"
+    )
+
+    parser.add_argument('-n', '--entries', type=int, help="Number of entries of the generated tree", default=20 * pow(10, 6))
+    parser.add_argument('-nn', '--naive_entries', type=int, help="Number of entries the naive representation is built for (memory is extrapolated to --entries)", default=2 * pow(10, 6))
+    parser.add_argument('-d', '--dirs_per_dir', type=int, help="Sub directories per directory of the generated tree", default=10)
+    parser.add_argument('-f', '--files_per_dir', type=int, help="Files per directory of the generated tree", default=50)
+    parser.add_argument('-u', '--unique_name_fraction', type=float, help="Fraction of file names that are unique in the whole tree", default=0.1)
+    parser.add_argument('-l', '--lookups', type=int, help="Number of random paths looked up", default=10000)
+    parser.add_argument('-b', '--bench_dir', help="Directory to write the manifest files to", default="/tmp/manifest-bench")
+    parser.add_argument('-o', '--json_output', help="Path to write the benchmark results to as json", default=None)
+
+    args = parser.parse_args()
+
+    os.makedirs(args.bench_dir, exist_ok=True)
+
+    listing_args = {
+        'dirs_per_dir': args.dirs_per_dir,
+        'files_per_dir': args.files_per_dir,
+        'unique_name_fraction': args.unique_name_fraction,
+    }
+    naive_entries = min(args.naive_entries, args.entries)
+
+    results = [
+        benchmark_compact(listing_args, args.entries, args.bench_dir, get_lookup_paths(listing_args, args.entries, args.lookups)),
+        # Last, as the memory of the dicts is not necessarily returned to the system
+        benchmark_naive(listing_args, naive_entries, args.bench_dir, get_lookup_paths(listing_args, naive_entries, args.lookups)),
+    ]
+
+    for result in results:
+        bytes_per_entry = result['memory_bytes'] / result['entries']
+        result['bytes_per_entry'] = round(bytes_per_entry, 1)
+        result['memory_MB'] = round(result['memory_bytes'] / pow(10, 6), 2)
+        result['memory_MB_at_N'] = round(bytes_per_entry * args.entries / pow(10, 6), 2)
+        result['file_MB'] = round(result['file_bytes'] / pow(10, 6), 2)
+        for key in ['build_s', 'save_s', 'load_s', 'scan_s', 'lookup_us']:
+            result[key] = round(result[key], 4)
+
+    try:
+        pretty_table(results, manifest_table_keys)
+    except ImportError:
+        ugly_print(results, manifest_table_keys)
+
+    if (args.json_output):
+        with open(args.json_output, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -144,8 +144,6 @@ run_options = ['-noappend', '-info', '-progress', '-wildcards']
 
 source_dir_path = '/home/pmarkus'
 
-# Note that without considering the excludes of mksquashfs the compression ratio that results from this is not accurate
-orig_dir_size_bytes = get_dir_size(source_dir_path)
 
 # mksquashfs(source_dir_path, '/home/pmarkus/target_squash_archive.img', compression_set, run_options)
 
@@ -266,13 +264,21 @@ def ugly_print(results, selected_keys):
         print(selected_fields)
 
 
-print("Timetable:")
-pretty_table(time_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
-print("Sizetable:")
-pretty_table(size_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
+def main():
+    # Note that without considering the excludes of mksquashfs the compression ratio that results from this is not accurate
+    orig_dir_size_bytes = get_dir_size(source_dir_path)
 
-print("Ratio reduction per second:")
-pretty_table(size_reduction_per_second_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
+    print("Timetable:")
+    pretty_table(time_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
+    print("Sizetable:")
+    pretty_table(size_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
+
+    print("Ratio reduction per second:")
+    pretty_table(size_reduction_per_second_table, ['label', 'time', 'ratio', 'size_reduction_per_second'])
+
+
+if __name__ == '__main__':
+    main()
 
 
 # Conclusions for algorithms:
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import isdir, join
+import argparse
+import json
+import subprocess
+import sys
+from backup_metrics import RunMetrics
+from archive_backends import SquashfsBackend
+from benchmark_backends import get_tree_size, to_mb
+from benchmark_mksquashfs import pretty_table, ugly_print
+from readahead import ReadAhead
+
+# Reads the same source with a cold page cache once without and once with the physical order read ahead
+# Dropping the page cache requires root, without it the second run is served from the cache and the results are meaningless
+
+readahead_table_keys = ['mode', 'duration_s', 'MBps', 'warmed_MB', 'speedup']
+
+
+def drop_caches():
+    return os.system("sync && echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null") == 0
+
+
+def get_reader_cmd(reader, source_dir, bench_dir):
+    if (reader == 'tar'):
+        # tar skips reading the file contents when writing to /dev/null directly
+        return f"tar --create --file=- --directory='{source_dir}' . | cat > /dev/null"
+
+    # Fastest compression, so that reading the source is the bottleneck
+    backend = SquashfsBackend()
+    base_cmd, image_path = backend.get_base_cmd(source_dir, backups_dir=bench_dir, compression_lvl=1, label_prefix="bench-readahead")
+    return " ".join(base_cmd)
+
+
+def run_reader(reader_cmd, source_dir, use_readahead, options):
+    run_metrics = RunMetrics('bench-readahead', source_dir)
+    read_ahead = None
+
+    def start_reader():
+        nonlocal read_ahead
+        reader_process = subprocess.Popen(reader_cmd, shell=True)
+
+        if (use_readahead):
+            read_ahead = ReadAhead(source_dir, reader_pid=reader_process.pid, max_window_bytes=options.readahead_window_mb * pow(2, 20), workers=options.readahead_workers)
+            read_ahead.start()
+
+        return reader_process
+
+    print(reader_cmd)
+    run_metrics.run_sampled('read', start_reader)
+
+    warmed_bytes = 0
+    if (read_ahead):
+        read_ahead.stop()
+        warmed_bytes = read_ahead.warmed_bytes
+
+    return run_metrics.phases['read'], warmed_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading a source dir with a cold page cache with and without the physical order read ahead"
+    )
+
+    parser.add_argument('source_dir', help="Source directory to read (ideally many small files on a spinning disk)")
+    parser.add_argument('-b', '--bench_dir', help="Directory to store the benchmark image in (should be on another disk than the source)", default="/tmp/readahead-bench")
+    parser.add_argument('-r', '--reader', choices=['mksquashfs', 'tar'], help="Program reading the source", default='mksquashfs')
+    parser.add_argument('-n', '--repetitions', type=int, help="Number of runs of each mode, the fastest run is reported", default=1)
+    parser.add_argument('-rw', '--readahead_window_mb', type=int, help="Maximum amount of data in MB read ahead", default=512)
+    parser.add_argument('-rj', '--readahead_workers', type=int, help="Number of threads issuing the read ahead", default=4)
+    parser.add_argument('-o', '--json_output', help="Path to write the benchmark results to as json", default=None)
+
+    args = parser.parse_args()
+
+    if (not isdir(args.source_dir)):
+        raise Exception(f"Source dir {args.source_dir} does not exist or is not a directory")
+
+    os.makedirs(args.bench_dir, exist_ok=True)
+
+    input_bytes = get_tree_size(args.source_dir)
+    print(f"Size of source dir {args.source_dir}: {to_mb(input_bytes)}MB")
+
+    reader_cmd = get_reader_cmd(args.reader, args.source_dir, args.bench_dir)
+
+    results = []
+    for mode, use_readahead in [('directory order', False), ('physical order read ahead', True)]:
+        durations = []
+        warmed_bytes = 0
+        for repetition in range(args.repetitions):
+            if (not drop_caches()):
+                print("Could not drop the page cache (requires root), results are not measured with a cold cache")
+
+            duration, warmed_bytes = run_reader(reader_cmd, args.source_dir, use_readahead, args)
+            durations.append(duration)
+
+        duration = min(durations)
+        results.append({
+            'mode': mode,
+            'duration_s': round(duration, 2),
+            'MBps': round(to_mb(input_bytes) / duration, 2) if duration > 0 else None,
+            'warmed_MB': to_mb(warmed_bytes),
+        })
+
+    for result in results:
+        result['speedup'] = round(results[0]['duration_s'] / result['duration_s'], 2) if result['duration_s'] > 0 else None
+
+    for file_name in os.listdir(args.bench_dir):
+        if (file_name.startswith('bench-readahead')):
+            os.remove(join(args.bench_dir, file_name))
+
+    try:
+        pretty_table(results, readahead_table_keys)
+    except ImportError:
+        ugly_print(results, readahead_table_keys)
+
+    if (args.json_output):
+        with open(args.json_output, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
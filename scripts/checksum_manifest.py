@@ -0,0 +1,289 @@
+import os
+from os.path import join
+import re
+import stat
+import time
+import hashlib
+import threading
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor
+from backup_metrics import is_process_running, get_process_tree_read_position
+
+# Per file checksum manifest of the source of an image
+# It is created while mksquashfs is reading the same tree, in the same order (depth first, entries sorted by name like mksquashfs does)
+# so that most files only need to be read from disk once and the second reader is served from the page cache
+
+hash_chunk_size = 1024 * 1024
+
+manifest_extension = '.manifest'
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def get_hash_algorithms():
+    algorithms = ['blake2b', 'blake2s', 'sha256']
+    if (xxhash):
+        algorithms.append('xxh3_128')
+    return algorithms
+
+
+def new_hasher(algorithm):
+    if (algorithm == 'xxh3_128'):
+        if (not xxhash):
+            raise Exception("Hash algorithm xxh3_128 requires the 'xxhash' python package")
+        return xxhash.xxh3_128()
+
+    return hashlib.new(algorithm)
+
+
+def hash_file(file_path, algorithm, read_throttle=None):
+    hasher = new_hasher(algorithm)
+    with open(file_path, 'rb') as hashed_file:
+        while True:
+            chunk = hashed_file.read(hash_chunk_size)
+            if (not chunk):
+                break
+            if (read_throttle):
+                read_throttle.consume(len(chunk))
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+# Matching of the mksquashfs '-wildcards' excludes, relative to the source dir:
+# 'a/b*' excludes entries whose path matches component by component from the root, '... b*' matches at any depth
+# Extended wildcards like '!(pattern)' are not supported here, those files are hashed anyway
+def parse_exclude_filters(exclude_filters):
+    parsed_filters = []
+    for exclude_filter in exclude_filters or []:
+        exclude_filter = exclude_filter.strip().strip("'")
+        if ('!(' in exclude_filter or len(exclude_filter) <= 0):
+            continue
+
+        anchored = True
+        if (exclude_filter.startswith('... ')):
+            anchored = False
+            exclude_filter = exclude_filter[4:]
+
+        parsed_filters.append((anchored, exclude_filter.strip('/').split('/')))
+
+    return parsed_filters
+
+
+def is_excluded(path_components, parsed_filters):
+    for anchored, pattern_components in parsed_filters:
+        pattern_length = len(pattern_components)
+        if (len(path_components) < pattern_length):
+            continue
+
+        start_indices = [0] if anchored else range(0, len(path_components) - pattern_length + 1)
+        for start_index in start_indices:
+            # The match has to end at the entry itself, excluded directories are not descended into
+            if (start_index + pattern_length != len(path_components)):
+                continue
+            if (all(fnmatchcase(path_components[start_index + index], pattern) for index, pattern in enumerate(pattern_components))):
+                return True
+
+    return False
+
+
+def walk_source_tree(source_dir, parsed_filters, path_components=None):
+    """Yields (relative path, DirEntry) of all files and symlinks in mksquashfs order, skipping excluded entries"""
+    path_components = path_components or []
+
+    try:
+        entries = sorted(os.scandir(join(source_dir, *path_components)), key=lambda entry: os.fsencode(entry.name))
+    except (PermissionError, FileNotFoundError) as err:
+        print(f"Can not read directory for manifest: {err}")
+        return
+
+    for entry in entries:
+        entry_components = path_components + [entry.name]
+        if (is_excluded(entry_components, parsed_filters)):
+            continue
+
+        # Like mksquashfs, sub directories are descended into at their position in the sorted entries
+        if (entry.is_dir(follow_symlinks=False)):
+            yield from walk_source_tree(source_dir, parsed_filters, entry_components)
+        elif (entry.is_file(follow_symlinks=False) or entry.is_symlink()):
+            yield '/'.join(entry_components), entry
+
+
+def hash_entry(rel_path, entry, algorithm):
+    try:
+        entry_stat = entry.stat(follow_symlinks=False)
+    except OSError as err:
+        # File was removed while walking the tree
+        print(f"Can not stat {entry.path}: {err}")
+        return None
+
+    try:
+        if (stat.S_ISLNK(entry_stat.st_mode)):
+            hasher = new_hasher(algorithm)
+            hasher.update(os.fsencode(os.readlink(entry.path)))
+            digest = hasher.hexdigest()
+        else:
+            digest = hash_file(entry.path, algorithm)
+    except OSError as err:
+        print(f"Can not hash {entry.path}: {err}")
+        digest = '-'
+
+    return digest, entry_stat.st_size, entry_stat.st_mtime_ns, rel_path
+
+
+def escape_manifest_path(path):
+    return path.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+manifest_path_escapes = {'\\\\': '\\', '\\t': '\t', '\\n': '\n'}
+
+
+def unescape_manifest_path(path):
+    return re.sub(r'\\[\\tn]', lambda match: manifest_path_escapes[match.group(0)], path)
+
+
+class ReaderWindow():
+    """Keeps the walk of the hasher within a window ahead of the bytes read by the archiving process"""
+
+    def __init__(self, reader_pid, window_bytes=256 * pow(2, 20), poll_interval=0.1):
+        self.reader_pid = reader_pid
+        self.window_bytes = window_bytes
+        self.poll_interval = poll_interval
+        self.walked_bytes = 0
+        # Last known read position, the process tree is only sampled again once the walk reaches the end of the window
+        self.read_position = 0
+
+    def wait_for_reader(self, file_size):
+        # Hashing is much faster than compressing, without waiting the hasher runs ahead until its pages are evicted
+        # before mksquashfs reads them and both processes read (and seek on) the disk
+        while (self.reader_pid and self.walked_bytes - self.read_position > self.window_bytes):
+            if (not is_process_running(self.reader_pid)):
+                # Archiving is done (or failed), the rest is hashed without waiting
+                self.reader_pid = None
+                break
+
+            read_position = get_process_tree_read_position(self.reader_pid)
+            if (read_position is None):
+                print("Can not read the io counters of the archiving process (requires root), the manifest is hashed without following it")
+                self.reader_pid = None
+                break
+
+            self.read_position = read_position
+            if (self.walked_bytes - self.read_position > self.window_bytes):
+                time.sleep(self.poll_interval)
+
+        self.walked_bytes += file_size
+
+
+def create_manifest_entries(source_dir, exclude_filters=None, algorithm='blake2b', workers=4, read_ahead=64, reader_window=None):
+    parsed_filters = parse_exclude_filters(exclude_filters)
+
+    # Bound the number of files in flight, so a slow disk does not queue up the whole tree in the executor
+    in_flight = threading.BoundedSemaphore(workers + read_ahead)
+    futures = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rel_path, entry in walk_source_tree(source_dir, parsed_filters):
+            if (reader_window):
+                try:
+                    reader_window.wait_for_reader(entry.stat(follow_symlinks=False).st_size)
+                except OSError:
+                    pass
+
+            in_flight.acquire()
+            future = executor.submit(hash_entry, rel_path, entry, algorithm)
+            future.add_done_callback(lambda _: in_flight.release())
+            futures.append(future)
+
+    # Results keep the walk order
+    return [future.result() for future in futures if future.result()]
+
+
+def write_manifest(manifest_path, entries, algorithm, source_dir, image_path=None):
+    image_digest = None
+    if (image_path and os.path.isfile(image_path)):
+        image_digest = hash_file(image_path, algorithm)
+
+    header = [
+        f"# algorithm: {algorithm}",
+        f"# source: {source_dir}",
+        f"# created: {time.strftime('%Y-%m-%dT%H:%M:%S')}",
+    ]
+    if (image_path):
+        header.append(f"# image: {os.path.basename(image_path)}")
+    if (image_digest):
+        header.append(f"# image_{algorithm}: {image_digest}")
+    header.append("# columns: hash, size, mtime_ns, path")
+
+    tmp_manifest_path = manifest_path + '.tmp'
+    with open(tmp_manifest_path, 'w', encoding='utf-8', errors='surrogateescape') as manifest_file:
+        manifest_file.write("\n".join(header) + "\n")
+        for digest, size, mtime_ns, rel_path in entries:
+            manifest_file.write(f"{digest}\t{size}\t{mtime_ns}\t{escape_manifest_path(rel_path)}\n")
+
+    os.replace(tmp_manifest_path, manifest_path)
+
+    return manifest_path
+
+
+def read_manifest(manifest_path):
+    """Returns the header values and the list of (hash, size, mtime_ns, path) entries of a manifest"""
+    header = {}
+    entries = []
+    with open(manifest_path, 'r', encoding='utf-8', errors='surrogateescape') as manifest_file:
+        for line in manifest_file:
+            line = line.rstrip('\n')
+            if (line.startswith('# ')):
+                key, _, value = line[2:].partition(': ')
+                header[key] = value
+                continue
+
+            digest, size, mtime_ns, rel_path = line.split('\t', 3)
+            entries.append((digest, int(size), int(mtime_ns), unescape_manifest_path(rel_path)))
+
+    return header, entries
+
+
+def get_manifest_path(image_path):
+    return image_path + manifest_extension
+
+
+class ManifestBuilder(threading.Thread):
+    """Hashes the source tree in the background while the archive is being created"""
+
+    def __init__(self, source_dir, exclude_filters=None, algorithm='blake2b', workers=4, run_metrics=None, reader_pid=None, window_bytes=256 * pow(2, 20)):
+        super().__init__(daemon=True)
+        # Hashing follows the archiving process (by its read bytes), so the files it reads are still in the page cache
+        self.reader_window = ReaderWindow(reader_pid, window_bytes) if reader_pid else None
+        self.source_dir = source_dir
+        self.exclude_filters = list(exclude_filters or [])
+        self.algorithm = algorithm
+        self.workers = workers
+        self.run_metrics = run_metrics
+        self.entries = None
+        self.error = None
+
+    def run(self):
+        start_time = time.monotonic()
+        try:
+            self.entries = create_manifest_entries(self.source_dir, self.exclude_filters, self.algorithm, self.workers, reader_window=self.reader_window)
+        except Exception as err:
+            self.error = err
+
+        if (self.run_metrics):
+            self.run_metrics.phases['manifest'] = time.monotonic() - start_time
+
+    def finish(self, image_path):
+        """Waits for the hashing to complete and writes the manifest next to the image, including the checksum of the image"""
+        self.join()
+
+        if (self.error):
+            raise self.error
+
+        manifest_path = write_manifest(get_manifest_path(image_path), self.entries, self.algorithm, self.source_dir, image_path)
+        print(f"Wrote checksum manifest of {len(self.entries)} files to {manifest_path}")
+
+        return manifest_path
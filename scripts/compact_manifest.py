@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import join
+import argparse
+import json
+import mmap
+import stat
+import sys
+from array import array
+from checksum_manifest import parse_exclude_filters, is_excluded, read_manifest
+
+# Per entry listing of an image for tens of millions of entries (catalogs, diffs, incremental runs)
+# A list of tuples or dicts costs a few hundred bytes per entry, this keeps the metadata in typed columns instead:
+# - every path component is stored once in a sorted name table, entries only hold the index of their name
+# - the directory of an entry is the index of its parent entry, so paths are not stored at all
+# - size, mtime, mode and inode are 'array' columns with fixed item sizes (36 bytes per entry in total)
+#
+# Entries are kept in tree order (depth first, siblings sorted by their encoded name, like mksquashfs and unsquashfs list them)
+# and the name table is sorted, so comparing the name indices of two paths compares the paths.
+# This is what the binary search and the merge join of two listings rely on.
+#
+# The file format is the columns written one after another (8 byte aligned), so a listing is loaded with mmap without copying
+
+compact_manifest_extension = '.cmanifest'
+compact_manifest_magic = b'SQCMF001'
+
+# Column -> array typecode, all typecodes have the same item size on every 64 bit linux platform
+entry_columns = {
+    # Index of the parent directory entry, -1 for entries in the root of the tree
+    'parent': 'i',
+    'name': 'I',
+    'size': 'Q',
+    'mtime_ns': 'q',
+    'mode': 'I',
+    'ino': 'Q',
+}
+
+column_alignment = 8
+
+
+def get_aligned(offset):
+    return (offset + column_alignment - 1) // column_alignment * column_alignment
+
+
+def split_path(path):
+    return [component for component in os.fsencode(path).split(b'/') if component and component != b'.']
+
+
+def decode_name(name):
+    return os.fsdecode(name)
+
+
+class NameTable():
+    """Sorted unique path components, stored as one bytes blob and the offsets of the names in it"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, name_id):
+        return bytes(self.blob[self.offsets[name_id]:self.offsets[name_id + 1]])
+
+    def get(self, name_id):
+        return decode_name(self.get_bytes(name_id))
+
+    def find(self, name):
+        """Index of the encoded name, -1 if no entry has this name"""
+        low = 0
+        high = len(self)
+        while (low < high):
+            middle = (low + high) // 2
+            if (self.get_bytes(middle) < name):
+                low = middle + 1
+            else:
+                high = middle
+
+        if (low < len(self) and self.get_bytes(low) == name):
+            return low
+
+        return -1
+
+
+class CompactManifestBuilder():
+    """Collects entries in tree order into the columns of a CompactManifest"""
+
+    def __init__(self):
+        self.columns = {column: array(typecode) for column, typecode in entry_columns.items()}
+        # Names get a provisional index in the order they are seen, they are sorted once all entries are added
+        self.name_ids = {}
+        # (name, entry index) of the directories containing the last added entry
+        self.open_dirs = []
+        self.last_components = []
+
+    def get_name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if (name_id is None):
+            name_id = len(self.name_ids)
+            self.name_ids[name] = name_id
+        return name_id
+
+    def append_entry(self, name, size, mtime_ns, mode, ino):
+        parent_index = self.open_dirs[-1][1] if self.open_dirs else -1
+        self.columns['parent'].append(parent_index)
+        self.columns['name'].append(self.get_name_id(name))
+        self.columns['size'].append(size)
+        self.columns['mtime_ns'].append(mtime_ns)
+        self.columns['mode'].append(mode)
+        self.columns['ino'].append(ino)
+
+        return len(self.columns['parent']) - 1
+
+    def add(self, path, size=0, mtime_ns=0, mode=0, ino=0):
+        components = split_path(path) if isinstance(path, str) else path
+        if (len(components) <= 0):
+            # The root of the tree itself is not an entry
+            return
+
+        if (components <= self.last_components):
+            raise Exception(f"Entries have to be added in tree order, {path} is added after {b'/'.join(self.last_components)}")
+        self.last_components = components
+
+        dir_components = components[:-1]
+        common_depth = 0
+        while (common_depth < len(self.open_dirs) and common_depth < len(dir_components) and self.open_dirs[common_depth][0] == dir_components[common_depth]):
+            common_depth += 1
+        del self.open_dirs[common_depth:]
+
+        # Listings without directory entries (like the checksum manifests) get empty directory entries for the parents
+        for dir_name in dir_components[common_depth:]:
+            self.open_dirs.append((dir_name, self.append_entry(dir_name, 0, 0, stat.S_IFDIR, 0)))
+
+        entry_index = self.append_entry(components[-1], size, mtime_ns, mode, ino)
+        if (stat.S_ISDIR(mode)):
+            self.open_dirs.append((components[-1], entry_index))
+
+    def finish(self, source=None):
+        sorted_names = sorted(self.name_ids)
+
+        name_remap = array('I', bytes(len(sorted_names) * array('I').itemsize))
+        for sorted_id, name in enumerate(sorted_names):
+            name_remap[self.name_ids[name]] = sorted_id
+        self.columns['name'] = array('I', map(name_remap.__getitem__, self.columns['name']))
+
+        name_offsets = array('Q', [0])
+        name_offset = 0
+        for name in sorted_names:
+            name_offset += len(name)
+            name_offsets.append(name_offset)
+
+        names = NameTable(b''.join(sorted_names), name_offsets)
+        self.name_ids = {}
+
+        return CompactManifest(names, self.columns, source)
+
+
+class CompactManifest():
+    """Metadata of all entries of a tree in tree order, backed by arrays or by a memory mapped file"""
+
+    def __init__(self, names, columns, source=None, mapped_file=None):
+        self.names = names
+        self.columns = columns
+        self.source = source
+        self.mapped_file = mapped_file
+
+        self.parents = columns['parent']
+        self.name_ids = columns['name']
+
+    def __len__(self):
+        return len(self.parents)
+
+    def get_name_id_chain(self, index):
+        chain = []
+        while (index >= 0):
+            chain.append(self.name_ids[index])
+            index = self.parents[index]
+        chain.reverse()
+        return chain
+
+    def get_components(self, index):
+        return [self.names.get_bytes(name_id) for name_id in self.get_name_id_chain(index)]
+
+    def get_path(self, index):
+        return decode_name(b'/'.join(self.get_components(index)))
+
+    def get_entry(self, index):
+        return {
+            'path': self.get_path(index),
+            'size': self.columns['size'][index],
+            'mtime_ns': self.columns['mtime_ns'][index],
+            'mode': self.columns['mode'][index],
+            'ino': self.columns['ino'][index],
+        }
+
+    def find(self, path):
+        """Index of the entry with the path (binary search), -1 if there is none"""
+        name_id_chain = []
+        for component in split_path(path):
+            name_id = self.names.find(component)
+            if (name_id < 0):
+                return -1
+            name_id_chain.append(name_id)
+
+        if (len(name_id_chain) <= 0):
+            return -1
+
+        low = 0
+        high = len(self)
+        while (low < high):
+            middle = (low + high) // 2
+            if (self.get_name_id_chain(middle) < name_id_chain):
+                low = middle + 1
+            else:
+                high = middle
+
+        if (low < len(self) and self.get_name_id_chain(low) == name_id_chain):
+            return low
+
+        return -1
+
+    def iter_components(self):
+        """Yields (index, path components) of all entries in tree order, without walking up the parents of every entry"""
+        # Stack of (entry index, components) of the directories of the current entry
+        open_dirs = []
+        for index in range(len(self)):
+            parent_index = self.parents[index]
+            while (open_dirs and open_dirs[-1][0] != parent_index):
+                open_dirs.pop()
+
+            components = (open_dirs[-1][1] if open_dirs else ()) + (self.names.get_bytes(self.name_ids[index]),)
+            open_dirs.append((index, components))
+            yield index, components
+
+    def save(self, manifest_path):
+        column_offsets = {}
+        data_offset = 0
+        for column in entry_columns:
+            column_offsets[column] = data_offset
+            data_offset = get_aligned(data_offset + len(self.columns[column]) * self.columns[column].itemsize)
+
+        name_offsets_offset = data_offset
+        data_offset = get_aligned(data_offset + len(self.names.offsets) * self.names.offsets.itemsize)
+        name_blob_offset = data_offset
+
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'source': self.source,
+            'entries': len(self),
+            'names': len(self.names),
+            'columns': {column: [typecode, column_offsets[column]] for column, typecode in entry_columns.items()},
+            'name_offsets': name_offsets_offset,
+            'name_blob': [name_blob_offset, len(self.names.blob)],
+        }).encode()
+        header_size = len(header).to_bytes(8, 'little')
+        data_start = get_aligned(len(compact_manifest_magic) + len(header_size) + len(header))
+
+        tmp_manifest_path = manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'wb') as manifest_file:
+            manifest_file.write(compact_manifest_magic + header_size + header)
+            for column in entry_columns:
+                manifest_file.seek(data_start + column_offsets[column])
+                self.columns[column].tofile(manifest_file)
+
+            manifest_file.seek(data_start + name_offsets_offset)
+            self.names.offsets.tofile(manifest_file)
+            manifest_file.seek(data_start + name_blob_offset)
+            manifest_file.write(self.names.blob)
+
+        os.replace(tmp_manifest_path, manifest_path)
+
+        return manifest_path
+
+    @classmethod
+    def load(cls, manifest_path):
+        """Maps the file into memory, the columns are views of the mapped pages and only read when accessed"""
+        with open(manifest_path, 'rb') as manifest_file:
+            mapped_file = mmap.mmap(manifest_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic_size = len(compact_manifest_magic)
+        if (mapped_file[:magic_size] != compact_manifest_magic):
+            mapped_file.close()
+            raise Exception(f"{manifest_path} is not a compact manifest")
+
+        header_size = int.from_bytes(mapped_file[magic_size:magic_size + 8], 'little')
+        header = json.loads(mapped_file[magic_size + 8:magic_size + 8 + header_size])
+        data_start = get_aligned(magic_size + 8 + header_size)
+
+        if (header['byteorder'] != sys.byteorder):
+            mapped_file.close()
+            raise Exception(f"{manifest_path} was written on a {header['byteorder']} endian machine")
+
+        mapped_view = memoryview(mapped_file)
+        entry_count = header['entries']
+
+        columns = {}
+        for column, (typecode, column_offset) in header['columns'].items():
+            column_start = data_start + column_offset
+            columns[column] = mapped_view[column_start:column_start + entry_count * array(typecode).itemsize].cast(typecode)
+
+        name_offsets_start = data_start + header['name_offsets']
+        name_offsets = mapped_view[name_offsets_start:name_offsets_start + (header['names'] + 1) * 8].cast('Q')
+        name_blob_start = data_start + header['name_blob'][0]
+        name_blob = mapped_view[name_blob_start:name_blob_start + header['name_blob'][1]]
+
+        return cls(NameTable(name_blob, name_offsets), columns, header['source'], mapped_file)
+
+    def close(self):
+        if (not self.mapped_file):
+            return
+
+        # The mapping can only be closed once no views of it are left
+        for column in self.columns.values():
+            column.release()
+        self.names.offsets.release()
+        self.names.blob.release()
+        self.mapped_file.close()
+        self.mapped_file = None
+
+
+def merge_join(left_entries, right_entries):
+    """Joins two (key, value) streams in tree order, yields (key, left value, right value) with None for the missing side"""
+    left_entries = iter(left_entries)
+    right_entries = iter(right_entries)
+    left = next(left_entries, None)
+    right = next(right_entries, None)
+
+    while (left is not None or right is not None):
+        if (right is None or (left is not None and left[0] < right[0])):
+            yield left[0], left[1], None
+            left = next(left_entries, None)
+        elif (left is None or right[0] < left[0]):
+            yield right[0], None, right[1]
+            right = next(right_entries, None)
+        else:
+            yield left[0], left[1], right[1]
+            left = next(left_entries, None)
+            right = next(right_entries, None)
+
+
+def walk_tree_entries(source_dir, parsed_filters, path_components=None):
+    """Yields (path components, stat) of all entries including directories in tree order, skipping excluded entries"""
+    path_components = path_components or []
+
+    try:
+        entries = sorted(os.scandir(join(source_dir, *path_components)), key=lambda entry: os.fsencode(entry.name))
+    except (PermissionError, FileNotFoundError) as err:
+        print(f"Can not read directory for manifest: {err}")
+        return
+
+    for entry in entries:
+        entry_components = path_components + [entry.name]
+        if (is_excluded(entry_components, parsed_filters)):
+            continue
+
+        try:
+            entry_stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+
+        yield [os.fsencode(component) for component in entry_components], entry_stat
+
+        if (stat.S_ISDIR(entry_stat.st_mode)):
+            yield from walk_tree_entries(source_dir, parsed_filters, entry_components)
+
+
+def build_from_source_tree(source_dir, exclude_filters=None):
+    builder = CompactManifestBuilder()
+    for components, entry_stat in walk_tree_entries(source_dir, parse_exclude_filters(exclude_filters)):
+        builder.add(components, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_mode, entry_stat.st_ino)
+
+    return builder.finish(source_dir)
+
+
+def build_from_checksum_manifest(manifest_path):
+    # Checksum manifests only contain files and symlinks without mode and inode, the directories are added empty
+    header, entries = read_manifest(manifest_path)
+    builder = CompactManifestBuilder()
+    for _, size, mtime_ns, rel_path in entries:
+        builder.add(rel_path, size, mtime_ns, stat.S_IFREG, 0)
+
+    return builder.finish(header.get('source'))
+
+
+def get_compact_manifest_path(image_path):
+    return image_path + compact_manifest_extension
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create a compact (memory mappable) listing of a source dir or checksum manifest, or look up paths in one"
+    )
+
+    parser.add_argument('source', help="Source directory, checksum manifest (.manifest) or compact manifest (.cmanifest)")
+    parser.add_argument('-o', '--output', help="Path to write the compact manifest to", default=None)
+    parser.add_argument('-e', '--exclude_filters', nargs='*', help="mksquashfs style wildcard excludes when listing a source dir", default=[])
+    parser.add_argument('-f', '--find', nargs='*', help="Paths to look up and print the metadata of", default=[])
+
+    args = parser.parse_args()
+
+    if (args.source.endswith(compact_manifest_extension)):
+        compact_manifest = CompactManifest.load(args.source)
+    elif (os.path.isdir(args.source)):
+        compact_manifest = build_from_source_tree(args.source, args.exclude_filters)
+    else:
+        compact_manifest = build_from_checksum_manifest(args.source)
+
+    print(f"{len(compact_manifest)} entries, {len(compact_manifest.names)} unique names, source: {compact_manifest.source}")
+
+    for path in args.find:
+        index = compact_manifest.find(path)
+        print(compact_manifest.get_entry(index) if index >= 0 else f"{path} not found")
+
+    if (args.output):
+        compact_manifest.save(args.output)
+        print(f"Written to {args.output} ({round(os.stat(args.output).st_size / pow(10, 6), 2)}MB)")
+
+    compact_manifest.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
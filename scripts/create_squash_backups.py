@@ -1,77 +1,17 @@
-import re
 import os
-from os.path import isdir, isfile, exists, expanduser, join
-from datetime import date
+from os.path import isdir, exists, join
 import argparse
 import sys
-
-# target_dir = "/backups"
-mount_images_dir = '/mnt'
-
-def get_squash_backup_base_cmd(source_dir, backups_dir=None, compression_lvl=17, label_prefix=""):
-
-    if (not backups_dir):
-        backups_dir = "/backups"
-
-    if (backups_dir and not exists(backups_dir)):
-        os.makedirs(backups_dir, exist_ok=True)
-
-    if (not exists(source_dir)):
-        raise Exception(f"Source dir {source_dir} does not exist")
-
-
-    fs_source_path_label = source_dir.replace('/', '-')
-    if(source_dir.strip() == "/"):
-        fs_source_path_label = "system"
-
-    if(label_prefix != ""):
-        label_prefix = label_prefix +  '__'
-
-
-    today = date.today()
-    today_date_string = today.strftime("%d-%m-%Y")
-
-    comp_algo = "zstd"
-    block_size = "256k"
-
-    settings_string = f"c_{comp_algo}-b_{block_size}-l_{compression_lvl}"
-
-    full_backup_name = label_prefix + fs_source_path_label + "-" + today_date_string + "-" + settings_string + '.squash.img'
-
-    if (full_backup_name[0] == '-'):
-        full_backup_name = full_backup_name[1:]
-
-    target_path = join(backups_dir, full_backup_name)
-
-    cmd = [
-        'sudo',
-        'mksquashfs',
-        source_dir,
-        target_path,
-        '-comp', comp_algo,
-        "-Xcompression-level", str(compression_lvl),
-        "-b", block_size,
-        "-mem", "1200M",
-        "-info", "-progress",
-        "-noappend"
-    ]
-
-    return cmd, target_path
-
-
-def get_filter_options(filters_arg):
-
-    if (not filters_arg):
-        return []
-
-    #cmd = ['-regex']
-    cmd = ['-wildcards']
-
-    for filter in filters_arg:
-        cmd.append('-e')
-        cmd.append(f"'{filter}'")
-
-    return cmd
+import subprocess
+import shutil
+import tempfile
+from backup_metrics import RunMetrics, timed_phase, export_run_metrics
+from archive_backends import archive_backends, get_archive_backend
+from checksum_manifest import ManifestBuilder, get_hash_algorithms
+from package_manifests import collect_package_manifests
+from readahead import ReadAhead
+from fingerprint_cache import get_fingerprint_cache_path, get_source_fingerprint, get_unchanged_image, set_last_image, save_fingerprint_cache, get_dir_content_hash, get_nested_dir_excludes, get_cached_source_size
+from run_history import get_history_path, get_host_load, load_run_history, record_run, predict_run, print_prediction, check_free_space
 
 
 """
@@ -96,6 +36,16 @@ def print_cmd_args(args, vertical=True):
     print(cmd)
 
 
+def get_run_label(source_dir, label_prefix=""):
+    if (label_prefix):
+        return label_prefix
+
+    if (source_dir.strip() == "/"):
+        return "system"
+
+    return source_dir.replace('/', '-').strip('-')
+
+
 def mk_squashfs_archive(source_dir, options):
 
     backup_dir = options.backups_dir
@@ -107,33 +57,155 @@ def mk_squashfs_archive(source_dir, options):
     if (options.sub_source_path):
         source_dir = join(source_dir, options.sub_source_path)
 
-    backup_cmd, target_image_path = get_squash_backup_base_cmd(source_dir, backups_dir=backup_dir, compression_lvl=options.compression_level, label_prefix=options.label_prefix)
+    backend = get_archive_backend(options)
 
-    target_image_name = os.path.basename(target_image_path)
-    options.exclude_regex_filters.append(f"... {str(target_image_name)}")
+    run_metrics = RunMetrics(get_run_label(source_dir, options.label_prefix), source_dir, {'backend': backend.name, 'compression_level': options.compression_level})
 
-    filter_options = get_filter_options(options.exclude_regex_filters)
+    with run_metrics.phase('command_build'):
+        backup_cmd, target_image_path = backend.get_base_cmd(source_dir, backups_dir=backup_dir, compression_lvl=options.compression_level, label_prefix=options.label_prefix)
 
-    full_cmd_args = backup_cmd + filter_options
-    full_cmd = " ".join(full_cmd_args)
+        target_image_name = os.path.basename(target_image_path)
+        add_to_exclude_expressions(options, [backend.get_self_exclude(target_image_name)])
+
+        filter_options = backend.get_filter_options(options.exclude_regex_filters)
+
+        full_cmd_args = backend.get_full_cmd_args(backup_cmd, filter_options, target_image_path, options.compression_level, getattr(options, 'generated_dir', None))
+        full_cmd = " ".join(full_cmd_args)
 
     # print(full_cmd)
 
     print_cmd_args(full_cmd_args)
     print("\n" + full_cmd)
 
+    settings = f"{backend.name}:{backend.get_settings_string(options.compression_level)}"
+    input_bytes = None
+
+    fingerprint_cache_path = get_fingerprint_cache_path(os.path.dirname(target_image_path), run_metrics.target)
+    # Without the exclude of today's image name, which would change the fingerprint every day,
+    # and without the backups and metrics dirs, which change with every run when they are inside the source
+    fingerprint_excludes = [exclude for exclude in options.exclude_regex_filters if exclude != backend.get_self_exclude(target_image_name)]
+    fingerprint_excludes += get_nested_dir_excludes(source_dir, [os.path.dirname(target_image_path), options.metrics_dir, options.textfile_collector_dir])
+    fingerprint_settings = settings
+    if (getattr(options, 'generated_dir', None)):
+        fingerprint_settings += ":" + get_dir_content_hash(options.generated_dir)
+
+    if (options.skip_unchanged):
+        with run_metrics.phase('fingerprint'):
+            root_fingerprint, input_bytes, input_files, fingerprint_cache = get_source_fingerprint(fingerprint_cache_path, source_dir, fingerprint_excludes, fingerprint_settings)
+
+        unchanged_image_path = get_unchanged_image(fingerprint_cache, root_fingerprint)
+        if (unchanged_image_path):
+            # The cache is not written, skipped runs leave the backups dir as it is
+            print(f"Source {source_dir} did not change since {unchanged_image_path} was created, skipping the backup")
+            return unchanged_image_path
+
+    history_path = None
+    prediction = None
+    if (not options.no_history):
+        history_path = get_history_path(os.path.dirname(target_image_path))
+
+        if (input_bytes is None):
+            with run_metrics.phase('scan'):
+                input_bytes, input_files = get_cached_source_size(fingerprint_cache_path, source_dir, fingerprint_excludes, fingerprint_settings)
+
+        prediction = predict_run(load_run_history(history_path), run_metrics.target, settings, input_bytes)
+        print_prediction(prediction)
+
     if (options.dry_run):
         return None
 
-    os.system(full_cmd)
+    if (not options.ignore_free_space and not check_free_space(os.path.dirname(target_image_path), prediction)):
+        raise Exception(f"Not enough free space to create {target_image_path}, use --ignore_free_space to create it anyway")
+
+    host_load = get_host_load()
+    run_metrics.set_value('image_path', target_image_path)
+
+    manifest_builder = None
+    read_ahead = None
+
+    def start_archiving():
+        nonlocal read_ahead, manifest_builder
+        # Popen instead of os.system, so that the resources of the archiving child processes (mksquashfs or tar/zstd) can be sampled
+        # pipefail, otherwise a failing tar is hidden behind the status of zstd (or of the stream command)
+        archive_process = subprocess.Popen(['bash', '-o', 'pipefail', '-c', full_cmd])
+
+        if (options.checksum_manifest):
+            # Follows the archiving process within a window, so both read the source tree at roughly the same time
+            manifest_builder = ManifestBuilder(source_dir, options.exclude_regex_filters, algorithm=options.hash_algorithm, workers=options.hash_workers, run_metrics=run_metrics,
+                                               reader_pid=archive_process.pid, window_bytes=options.hash_window_mb * pow(2, 20))
+            manifest_builder.start()
+
+        if (options.readahead):
+            read_ahead = ReadAhead(source_dir, options.exclude_regex_filters, reader_pid=archive_process.pid, max_window_bytes=options.readahead_window_mb * pow(2, 20), workers=options.readahead_workers)
+            read_ahead.start()
+
+        return archive_process
+
+    return_code = run_metrics.run_sampled('compression', start_archiving, interval=options.sample_interval)
+
+    if (read_ahead):
+        read_ahead.stop()
+
+    if (manifest_builder and return_code == 0):
+        try:
+            run_metrics.set_value('manifest_path', manifest_builder.finish(target_image_path))
+        except Exception as err:
+            # The image is already written, a missing manifest must not stop its verification and the metrics of the run
+            print(f"Checksum manifest of {target_image_path} could not be created: {err}")
+            run_metrics.set_value('manifest_path', None)
+            run_metrics.set_value('manifest_error', str(err))
 
     print("Ran command:")
     print("\n" + full_cmd)
 
+    if (exists(target_image_path)):
+        run_metrics.set_value('output_bytes', os.stat(target_image_path).st_size)
+
+    if (return_code != 0):
+        # A partially written image can still pass the verification (or verification is skipped), never count it as a backup
+        print(f"Archiving failed with return code {return_code}, {target_image_path} is not a valid backup")
+        verified_image_path = None
+    else:
+        verified_image_path = verify_created_image(target_image_path, backend, options, run_metrics)
+
+    run_metrics.set_value('success', 1 if verified_image_path else 0)
+    export_run_metrics(run_metrics, metrics_dir=options.metrics_dir, textfile_dir=options.textfile_collector_dir)
+
+    if (options.skip_unchanged and verified_image_path):
+        # Files that changed while the image was created are detected by the next scan, as their mtime is newer than the scan
+        set_last_image(fingerprint_cache, root_fingerprint, verified_image_path)
+        save_fingerprint_cache(fingerprint_cache_path, fingerprint_cache)
+
+    if (history_path and 'output_bytes' not in run_metrics.values):
+        # Streamed archives are not written to the backups dir, a run without output size would break the size predictions
+        print(f"Size of {target_image_path} is unknown (streamed or not created), the run is not added to the history")
+    elif (history_path):
+        record_run(history_path, {
+            'timestamp': run_metrics.start_timestamp,
+            'target': run_metrics.target,
+            'settings': settings,
+            'image_path': target_image_path,
+            'input_bytes': input_bytes,
+            'input_files': input_files,
+            'output_bytes': run_metrics.values['output_bytes'],
+            # Only the archiving itself, so the prediction does not depend on whether verification was skipped
+            'duration_s': round(run_metrics.phases['compression'], 2),
+            'host_load': host_load,
+            'success': bool(verified_image_path),
+        })
+
+    return verified_image_path
+
+
+def verify_created_image(target_image_path, backend, options, run_metrics=None):
+
     if (options.no_verify):
         return target_image_path
 
-    if (not exists(target_image_path) or not verify_squashfs(target_image_path)):
+    with timed_phase(run_metrics, 'verification'):
+        is_valid = backend.verify(target_image_path, run_metrics)
+
+    if (not is_valid):
         print(f"Verification of {target_image_path} failed, please check if the image is valid manually or create the archive/image again")
         return None
 
@@ -160,6 +232,7 @@ def get_universal_excludes():
         'node_modules',
         '... node_modules',
         '... *.squash.img',
+        '... *.tar.zst',
         #'^node\_modules',
         #'.*/node\_modules',
         #'^node_modules',
@@ -455,27 +528,96 @@ def add_to_exclude_expressions(options, add_expr_list):
     options.exclude_regex_filters += add_expr_list
 
 
+# Source dir and excludes of the preconfigured targets, also used to list a source like the images of its target (diff_backups)
+def get_home_norepo_target():
+    return os.path.expanduser('~'), get_home_excludes_expressions() + ['repos']
+
+
+def get_home_target():
+    return os.path.expanduser('~'), get_home_excludes_expressions()
+
+
+def get_sys_nohome_target():
+    return '/', get_sys_excludes_expressions() + ['home']
+
+
+def get_sys_data_nohome_target():
+    return '/', get_sys_excludes_expressions() + get_sys_data_excludes() + ['home']
+
+
+def get_sys_packages_target():
+    return '/', get_excludes_except('/', get_sys_data_backup_dirs()) + get_var_lib_package_excludes() + get_universal_excludes()
+
+
 def backup_home_norepo(options):
-    current_user_home = os.path.expanduser('~')
-    add_to_exclude_expressions(options, get_home_excludes_expressions() + ['repos'])
+    current_user_home, excludes = get_home_norepo_target()
+    add_to_exclude_expressions(options, excludes)
 
     return mk_squashfs_archive(current_user_home, options)
 
 
 def backup_home(options):
-    current_user_home = os.path.expanduser('~')
-    add_to_exclude_expressions(options, get_home_excludes_expressions())
+    current_user_home, excludes = get_home_target()
+    add_to_exclude_expressions(options, excludes)
 
     return mk_squashfs_archive(current_user_home, options)
 
 def backup_sys_nohome(options):
-    add_to_exclude_expressions(options, get_sys_excludes_expressions() + ['home'])
-    return mk_squashfs_archive('/', options)
+    source_dir, excludes = get_sys_nohome_target()
+    add_to_exclude_expressions(options, excludes)
+    return mk_squashfs_archive(source_dir, options)
 
 
 def backup_sys_data_nohome(options):
-    add_to_exclude_expressions(options, get_sys_excludes_expressions() + get_sys_data_excludes() + ['home'])
-    return mk_squashfs_archive('/', options)
+    source_dir, excludes = get_sys_data_nohome_target()
+    add_to_exclude_expressions(options, excludes)
+    return mk_squashfs_archive(source_dir, options)
+
+# Everything else of the system is either reinstalled from the package lists or is runtime data
+def get_sys_data_backup_dirs():
+    return [
+        '/etc',
+        '/srv',
+        '/usr/local',
+        '/var/lib',
+    ]
+
+
+# Package manager state and payloads in var/lib, restored by reinstalling from the package lists
+def get_var_lib_package_excludes():
+    return [
+        'var/lib/apt',
+        'var/lib/dpkg',
+        'var/lib/dkms',
+        'var/lib/flatpak',
+        'var/lib/snapd',
+        'var/lib/docker/!(*volumes*)',
+    ]
+
+
+def get_excludes_except(root_dir, kept_paths):
+    """Excludes for all entries of root_dir that are not one of the kept paths or one of their parents"""
+    kept_rel_paths = [os.path.relpath(kept_path, root_dir) for kept_path in kept_paths]
+
+    parent_rel_paths = set()
+    for kept_rel_path in kept_rel_paths:
+        path_components = kept_rel_path.split('/')
+        for index in range(1, len(path_components)):
+            parent_rel_paths.add('/'.join(path_components[:index]))
+
+    excludes = []
+    for parent_rel_path in [''] + sorted(parent_rel_paths):
+        parent_dir = join(root_dir, parent_rel_path)
+        if (not isdir(parent_dir)):
+            continue
+
+        for entry_name in sorted(os.listdir(parent_dir)):
+            rel_path = join(parent_rel_path, entry_name) if parent_rel_path else entry_name
+            if (rel_path not in kept_rel_paths and rel_path not in parent_rel_paths):
+                excludes.append(rel_path)
+
+    return excludes
+
 
 def create_data_backups(options):
     #1. Create one data backup for each user (back up configuration/setting files and user data, but no application binaries, libs or runtime data)
@@ -483,7 +625,6 @@ def create_data_backups(options):
     #2. Create sys backup mainly for /etc, /srv, /usr/local/share, /usr/local/etc , maybe usr/local + a dpkg list + flatpak list + snap list
     # Optional: /usr/local -> libs and binaries built by sysadmin (not from dist pkg manager), usr/local/share, usr/share (readonly) (architecture-independent shareable text files)
     #https://www.ibm.com/docs/en/aix/7.1?topic=tree-usrshare-directory
-    print("test")
     #Data backup for sys:
         # etc - system wide configurations (important) - bootloader conf, sshd conf, firewall, device mount locations (fstab)
         # /var/snap - proably not important but to be on the safe side, containes runtime persistant variable state data for snaps
@@ -500,6 +641,24 @@ def create_data_backups(options):
         # /snap might have some data??
         # /var for the most part this is persistant runtime applications data - only really useful when trying to restore an application to that state, by copying (without going through the package manager)
 
+    backed_up_dirs = get_sys_data_backup_dirs()
+    source_dir, excludes = get_sys_packages_target()
+    add_to_exclude_expressions(options, excludes)
+
+    if (options.dry_run):
+        print("Dry run, the package lists are not collected")
+        return mk_squashfs_archive(source_dir, options)
+
+    generated_dir = tempfile.mkdtemp(prefix='backup-generated-')
+    try:
+        collect_package_manifests(generated_dir, backed_up_dirs)
+        options.generated_dir = generated_dir
+        return mk_squashfs_archive(source_dir, options)
+    finally:
+        shutil.rmtree(generated_dir, ignore_errors=True)
+        if (os.path.exists(generated_dir + '.pseudo')):
+            os.remove(generated_dir + '.pseudo')
+
 target_mapper = {
     'home_no_repo': backup_home_norepo,
     'homenorepo': backup_home_norepo,
@@ -507,86 +666,22 @@ target_mapper = {
     'sys_no_home': backup_sys_nohome,
     'sysnohome': backup_sys_nohome,
     'sys_data_no_home': backup_sys_data_nohome,
-    'sysdatanohome': backup_sys_data_nohome
+    'sysdatanohome': backup_sys_data_nohome,
+    'sys_packages': create_data_backups,
+    'syspackages': create_data_backups,
 }
 
-# Note that this does not work with the mksquashfs '-nopad' option, as the resulting image is not mountable
-def mount_squashfs_image(image_path, label):
-
-    if (not exists(image_path)):
-        raise Exception(f"Can not mount image to system, image at path '{image_path}' does not exist")
-
-    if (os.stat(image_path).st_size <= 0):
-        raise Exception(f"Can not mount image to system, image at path '{image_path}' is empty")
-
-    if (not label or len(label) <= 0):
-        raise Exception(f"Label of mount point has to be non empty")
-
-    mount_dir = join(mount_images_dir, label)
-    # os.makedirs(mount_dir)
-    # os.system(f"sudo mkdir -p {mount_dir} && sudo umount -l {mount_dir} && sudo mount {image_path} {mount_dir}")
-
-    print(f"sudo mount {image_path} {mount_dir}")
-    os.system(f"sudo mkdir -p {mount_dir} && sudo mount {image_path} {mount_dir}")
-
-    os.system(f"du -h -d 1 {mount_dir}")
-
-    return mount_dir
-
-
-def umount_mount(mount_point):
-
-    if (not exists(mount_point)):
-        raise Exception(f"Can not unmount point at '{mount_point}' the path does not exist")
-
-    print(f"sudo umount -l {mount_point}")
-    os.system(f"sudo umount -l {mount_point}")
-    os.system(f"sudo rm -d {mount_point}")
-
-
-def umount_labeled(mount_label):
-    mount_dir = join(mount_images_dir, mount_label)
-    umount_mount(mount_dir)
-
-
-def dir_tree_has_files(directory):
-    if (not directory or not exists(directory)):
-        return False
-
-    print("\nFiles in image: ")
-    print("\n".join(os.listdir(directory)))
-    print("\n")
-
-    for file in os.scandir(directory):
-        if (isfile(file)):
-            return True
-
-    return False
-
-
-def verify_squashfs(image_path):
-
-    import uuid
-    random_uuid_string = str(uuid.uuid4())
-    print(random_uuid_string)
-
-    try:
-        mounted_dir_path = mount_squashfs_image(image_path, random_uuid_string)
-
-        has_files = dir_tree_has_files(mounted_dir_path)
-
-        if (os.stat(image_path).st_size >= 0):
-            file_size = str(int(os.stat(image_path).st_size / pow(10, 3)))
-            print(f"The image has a file size of {file_size}kB")
-
-    except Exception as err:
-        umount_mount(mounted_dir_path)
-        raise err
-
-    umount_mount(mounted_dir_path)
-
-    return has_files
-
+target_sources = {
+    'home_no_repo': get_home_norepo_target,
+    'homenorepo': get_home_norepo_target,
+    'home': get_home_target,
+    'sys_no_home': get_sys_nohome_target,
+    'sysnohome': get_sys_nohome_target,
+    'sys_data_no_home': get_sys_data_nohome_target,
+    'sysdatanohome': get_sys_data_nohome_target,
+    'sys_packages': get_sys_packages_target,
+    'syspackages': get_sys_packages_target,
+}
 
 def main():
     parser = argparse.ArgumentParser(
@@ -605,6 +700,23 @@ def main():
     parser.add_argument('-nv', '--no_verify', "--skip_verify", action="store_true", help="Do not verify that the resulting image is mountable and readable after creating it")
     parser.add_argument('-sub', '--sub_source_path', '--sub_source', help="Sub path of the source path to use for making an image instead (Mainly for debugging as it can break some excludes regexp)", default=None)
     parser.add_argument('-pre', '--label_prefix', help="Label prefix for the resulting file (is set automatically to target)", default="")
+    parser.add_argument('-be', '--backend', choices=archive_backends.keys(), help="Archive format to create: squashfs image or streamed tar archive compressed with multithreaded zstd", default="squashfs")
+    parser.add_argument('-zt', '--zstd_threads', type=int, help="Number of zstd compression threads of the tar backend (0 uses all cores)", default=0)
+    parser.add_argument('-zl', '--zstd_long', type=int, help="Window log of zstd long distance matching of the tar backend", default=27)
+    parser.add_argument('-pipe', '--stream_cmd', help="Shell command to pipe the archive into instead of writing it to the backups dir (tar backend only)", default=None)
+    parser.add_argument('-mf', '--checksum_manifest', '--manifest', action="store_true", help="Hash every file of the source while the image is created and store the manifest next to the image")
+    parser.add_argument('-ha', '--hash_algorithm', choices=get_hash_algorithms(), help="Hash algorithm of the checksum manifest (xxh3_128 requires the xxhash package)", default="blake2b")
+    parser.add_argument('-hw', '--hash_workers', type=int, help="Number of threads hashing files for the checksum manifest", default=4)
+    parser.add_argument('-hwin', '--hash_window_mb', type=int, help="Maximum amount of data in MB the checksum manifest hashing runs ahead of the archiving", default=256)
+    parser.add_argument('-nh', '--no_history', action="store_true", help="Do not scan the source size, predict duration and image size or record the run in the history of the backups dir")
+    parser.add_argument('-ifs', '--ignore_free_space', action="store_true", help="Create the image even if the predicted size exceeds the free space of the backups dir")
+    parser.add_argument('-ra', '--readahead', action="store_true", help="Read the files ahead of mksquashfs in physical disk order (FIEMAP), turns seek bound reading of many small files on HDDs into sequential reads")
+    parser.add_argument('-rw', '--readahead_window_mb', type=int, help="Maximum amount of data in MB read ahead of mksquashfs (reduced when the page cache is small)", default=512)
+    parser.add_argument('-rj', '--readahead_workers', type=int, help="Number of threads issuing the read ahead", default=4)
+    parser.add_argument('-su', '--skip_unchanged', action="store_true", help="Skip the backup if the stat metadata fingerprint of the source did not change since the last successful image of the target")
+    parser.add_argument('-md', '--metrics_dir', help="Directory to write a json report with phase timings and mksquashfs resource usage of each run to", default=None)
+    parser.add_argument('-prom', '--textfile_collector_dir', '--prometheus_dir', help="Directory of the node_exporter textfile collector to write the metrics of the run to (example: /var/lib/node_exporter/textfile_collector)", default=None)
+    parser.add_argument('-si', '--sample_interval', type=float, help="Interval in seconds in which the cpu, memory and io usage of mksquashfs is sampled", default=1.0)
 
     args = parser.parse_args()
 
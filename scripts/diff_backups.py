@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import isdir, exists, join
+import argparse
+import json
+import stat
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime
+from functools import lru_cache
+from archive_backends import get_backend_for_image
+from benchmark_mksquashfs import pretty_table, ugly_print
+from checksum_manifest import get_manifest_path, read_manifest
+from compact_manifest import CompactManifest, build_from_source_tree, compact_manifest_extension, merge_join
+from create_squash_backups import target_sources
+from squashfs_mount import acquire_pool_mount, release_pool_lease
+
+# Differences between two images (or an image and a source dir) without reading the contents of unchanged files
+# Both sides are read as metadata listings in tree order (unsquashfs lists the sorted squashfs directories depth first),
+# so they are merge joined in one streaming pass. Only the files whose size stayed the same but whose mtime changed
+# are compared by content: through the checksum manifests of the images if both exist, otherwise by reading them
+# from pool mounts of the images
+
+unsquashfs_root = b'squashfs-root'
+
+mode_type_chars = {
+    ord('-'): stat.S_IFREG,
+    ord('d'): stat.S_IFDIR,
+    ord('l'): stat.S_IFLNK,
+    ord('c'): stat.S_IFCHR,
+    ord('b'): stat.S_IFBLK,
+    ord('p'): stat.S_IFIFO,
+    ord('s'): stat.S_IFSOCK,
+}
+
+# (position in the mode string, bit if set, special bit if the char is s/t, special bit if the char is S/T)
+mode_permission_bits = [
+    (1, stat.S_IRUSR, 0, 0), (2, stat.S_IWUSR, 0, 0), (3, stat.S_IXUSR, stat.S_ISUID, stat.S_ISUID),
+    (4, stat.S_IRGRP, 0, 0), (5, stat.S_IWGRP, 0, 0), (6, stat.S_IXGRP, stat.S_ISGID, stat.S_ISGID),
+    (7, stat.S_IROTH, 0, 0), (8, stat.S_IWOTH, 0, 0), (9, stat.S_IXOTH, stat.S_ISVTX, stat.S_ISVTX),
+]
+
+diff_categories = ['added', 'removed', 'modified', 'touched', 'permission_changed']
+
+diff_table_keys = ['top_level_dir', 'added', 'added_MB', 'removed', 'removed_MB', 'modified', 'modified_MB', 'touched', 'permission_changed', 'size_delta_MB']
+
+
+@lru_cache(maxsize=4096)
+def parse_mode_string(mode_string):
+    """Numeric mode of an 'ls -l' style mode string like drwxr-xr-x"""
+    mode = mode_type_chars.get(mode_string[0], 0)
+    for position, bit, set_special_bit, unset_special_bit in mode_permission_bits:
+        char = mode_string[position]
+        if (char in b'rwx'):
+            mode |= bit
+        elif (char in b'st'):
+            mode |= bit | set_special_bit
+        elif (char in b'ST'):
+            mode |= unset_special_bit
+
+    return mode
+
+
+@lru_cache(maxsize=65536)
+def parse_listing_time(date_time_string):
+    # Listed in local time by unsquashfs and tar, both sides of a diff are parsed the same way
+    date_time_string = date_time_string.decode()
+    time_format = "%Y-%m-%d %H:%M:%S" if date_time_string.count(':') >= 2 else "%Y-%m-%d %H:%M"
+    return int(datetime.strptime(date_time_string, time_format).timestamp()) * pow(10, 9)
+
+
+def parse_size(size_string):
+    # Device files list 'major,minor' instead of a size
+    return int(size_string) if size_string.isdigit() else 0
+
+
+class Listing():
+    """Metadata of the entries of an image or dir, iterated in tree order as (path components, (size, mtime_ns, mode, owner, link))"""
+
+    # Precision of the listed mtimes, mtimes are compared at the coarser precision of both sides
+    mtime_resolution_ns = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        raise NotImplementedError()
+
+    def get_content_root(self):
+        """Directory the files of the listing can be read from, None if the files can not be read"""
+        return None
+
+    def close(self):
+        pass
+
+
+@lru_cache(maxsize=1)
+def unsquashfs_has_full_precision():
+    # -full-precision (squashfs-tools >= 4.6) lists the seconds of the mtimes
+    try:
+        help_process = subprocess.run(['unsquashfs', '-help'], capture_output=True)
+    except FileNotFoundError:
+        return False
+
+    return b'-full-precision' in help_process.stdout + help_process.stderr
+
+
+class SquashfsListing(Listing):
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.pool_mount_dir = None
+        self.full_precision = unsquashfs_has_full_precision()
+        # Without -full-precision unsquashfs -lls only prints the minutes
+        self.mtime_resolution_ns = pow(10, 9) if self.full_precision else 60 * pow(10, 9)
+
+    def __iter__(self):
+        cmd = ['unsquashfs', '-lls'] + (['-full-precision'] if self.full_precision else []) + ['-d', unsquashfs_root.decode(), self.path]
+        print(" ".join(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        root_prefix = unsquashfs_root + b'/'
+
+        try:
+            for line in process.stdout:
+                # mode owner/group size date time path, other lines (processor count, inode count) are skipped
+                fields = line.rstrip(b'\n').split(None, 5)
+                if (len(fields) < 6 or fields[0][0] not in mode_type_chars or not fields[5].startswith(root_prefix)):
+                    continue
+
+                mode_string, owner, size, date, time_of_day, path = fields
+                mode = parse_mode_string(mode_string)
+
+                link = None
+                if (stat.S_ISLNK(mode)):
+                    path, _, link = path.partition(b' -> ')
+
+                yield tuple(path[len(root_prefix):].split(b'/')), (parse_size(size), parse_listing_time(date + b' ' + time_of_day), mode, owner, link)
+        finally:
+            process.stdout.close()
+            if (process.wait() != 0):
+                raise Exception(f"Listing {self.path} with unsquashfs failed")
+
+    def get_content_root(self):
+        try:
+            self.pool_mount_dir = acquire_pool_mount(self.path)
+        except PermissionError as err:
+            print(f"Can not mount {self.path}: {err}")
+            return None
+
+        return self.pool_mount_dir
+
+    def close(self):
+        # The image stays mounted for the next diff, it can be evicted once no running diff uses it
+        if (self.pool_mount_dir):
+            release_pool_lease(self.path)
+
+
+class TarZstdListing(Listing):
+    """Listing of a tar archive, which is loaded and sorted in memory as a whole (a few hundred bytes per entry)
+
+    The members of a tar archive are in the order they were added (readdir order, generated files last), not in tree order,
+    so unlike the other listings it can not be streamed. For archives with tens of millions of entries, build compact manifests
+    from their checksum manifests (compact_manifest.py) and diff those instead
+    """
+    mtime_resolution_ns = pow(10, 9)
+
+    def __iter__(self):
+        backend = get_backend_for_image(self.path)
+        list_cmd = f"zstd -dc {' '.join(backend.get_zstd_options())} '{self.path}' | tar --list --verbose --full-time --file=-"
+        print(list_cmd)
+        process = subprocess.Popen(['bash', '-o', 'pipefail', '-c', list_cmd], stdout=subprocess.PIPE)
+
+        entries = []
+        for line in process.stdout:
+            fields = line.rstrip(b'\n').split(None, 5)
+            if (len(fields) < 6):
+                continue
+
+            mode_string, owner, size, date, time_of_day, path = fields
+            mode = parse_mode_string(mode_string)
+
+            link = None
+            if (stat.S_ISLNK(mode)):
+                path, _, link = path.partition(b' -> ')
+            elif (b' link to ' in path):
+                path, _, link = path.partition(b' link to ')
+
+            components = tuple(component for component in path.split(b'/') if component and component != b'.')
+            if (len(components) > 0):
+                entries.append((components, (parse_size(size), parse_listing_time(date + b' ' + time_of_day), mode, owner, link)))
+
+        if (process.wait() != 0):
+            raise Exception(f"Listing {self.path} with tar failed")
+
+        entries.sort(key=lambda entry: entry[0])
+        yield from entries
+
+
+class CompactListing(Listing):
+    """Listing of a compact manifest file or of a source directory (owners and link targets are not compared)"""
+
+    def __init__(self, path, exclude_filters=None):
+        super().__init__(path)
+        if (isdir(path)):
+            # The excludes of the target, otherwise everything excluded from the image is listed as added
+            self.compact_manifest = build_from_source_tree(path, exclude_filters)
+        else:
+            self.compact_manifest = CompactManifest.load(path)
+
+    def __iter__(self):
+        columns = self.compact_manifest.columns
+        for index, components in self.compact_manifest.iter_components():
+            yield components, (columns['size'][index], columns['mtime_ns'][index], columns['mode'][index], None, None)
+
+    def get_content_root(self):
+        return self.path if isdir(self.path) else None
+
+    def close(self):
+        self.compact_manifest.close()
+
+
+def get_listing(path, exclude_filters=None):
+    if (isdir(path) or path.endswith(compact_manifest_extension)):
+        return CompactListing(path, exclude_filters)
+
+    backend = get_backend_for_image(path)
+    if (backend and backend.name == 'tar_zstd'):
+        return TarZstdListing(path)
+    if (backend):
+        return SquashfsListing(path)
+
+    raise Exception(f"Can not list {path}, it is neither a directory, a compact manifest nor a backup image")
+
+
+def classify_change(old_entry, new_entry, mtime_resolution_ns):
+    """Categories of the metadata change of an entry, 'compare' if only the content can tell whether it was modified"""
+    old_size, old_mtime_ns, old_mode, old_owner, old_link = old_entry
+    new_size, new_mtime_ns, new_mode, new_owner, new_link = new_entry
+
+    categories = []
+    if (stat.S_IMODE(old_mode) != stat.S_IMODE(new_mode) or (old_owner is not None and new_owner is not None and old_owner != new_owner)):
+        categories.append('permission_changed')
+
+    if (stat.S_IFMT(old_mode) != stat.S_IFMT(new_mode)):
+        categories.append('modified')
+    elif (stat.S_ISDIR(new_mode)):
+        # Sizes and mtimes of directories change with every added or removed entry, which is already reported for the entries
+        pass
+    elif (old_size != new_size or (old_link is not None and new_link is not None and old_link != new_link)):
+        categories.append('modified')
+    elif (old_mtime_ns // mtime_resolution_ns != new_mtime_ns // mtime_resolution_ns):
+        categories.append('compare' if stat.S_ISREG(new_mode) else 'modified')
+
+    return categories
+
+
+def new_dir_totals():
+    totals = {category: 0 for category in diff_categories}
+    totals.update({'added_bytes': 0, 'removed_bytes': 0, 'modified_bytes': 0, 'size_delta_bytes': 0})
+    return totals
+
+
+def get_top_level_dir(components):
+    # Files in the root of the image are summed up as '.'
+    return os.fsdecode(components[0]) if len(components) > 1 else '.'
+
+
+def add_to_totals(dir_totals, category, components, old_entry, new_entry):
+    totals = dir_totals.setdefault(get_top_level_dir(components), new_dir_totals())
+    totals[category] += 1
+
+    # Sizes of directories are the sizes of their directory tables, only files count towards the totals
+    old_size = old_entry[0] if old_entry and not stat.S_ISDIR(old_entry[2]) else 0
+    new_size = new_entry[0] if new_entry and not stat.S_ISDIR(new_entry[2]) else 0
+
+    if (category == 'added'):
+        totals['added_bytes'] += new_size
+    elif (category == 'removed'):
+        totals['removed_bytes'] += old_size
+    elif (category == 'modified'):
+        totals['modified_bytes'] += new_size
+    else:
+        return
+
+    totals['size_delta_bytes'] += new_size - old_size
+
+
+def get_change_record(path, old_entry, new_entry):
+    record = {'path': path}
+    if (old_entry):
+        record.update({'old_size': old_entry[0], 'old_mtime': old_entry[1] // pow(10, 9), 'old_mode': oct(old_entry[2])})
+    if (new_entry):
+        record.update({'new_size': new_entry[0], 'new_mtime': new_entry[1] // pow(10, 9), 'new_mode': oct(new_entry[2])})
+    return record
+
+
+def files_are_equal(old_file_path, new_file_path, chunk_size=1024 * 1024):
+    try:
+        with open(old_file_path, 'rb') as old_file, open(new_file_path, 'rb') as new_file:
+            while True:
+                old_chunk = old_file.read(chunk_size)
+                if (old_chunk != new_file.read(chunk_size)):
+                    return False
+                if (not old_chunk):
+                    return True
+    except OSError as err:
+        print(f"Can not compare {new_file_path}: {err}")
+        return False
+
+
+def load_manifest_digests(image_path):
+    manifest_path = get_manifest_path(image_path)
+    if (not exists(manifest_path)):
+        return None
+
+    header, entries = read_manifest(manifest_path)
+    return {rel_path: digest for digest, _, _, rel_path in entries}
+
+
+def load_listing_digests(old_listing, new_listing):
+    """Checksums of the files of both sides (relative path -> digest), None if one of them has no checksum manifest"""
+    old_digests = load_manifest_digests(old_listing.path)
+    new_digests = load_manifest_digests(new_listing.path) if old_digests is not None else None
+
+    if (old_digests is None or new_digests is None):
+        return None
+
+    return old_digests, new_digests
+
+
+def compare_contents(old_listing, new_listing, paths, workers, digests=None):
+    """Paths of the files whose contents differ"""
+    digests = digests or load_listing_digests(old_listing, new_listing)
+
+    if (digests):
+        old_digests, new_digests = digests
+        print(f"Comparing {len(paths)} files by the checksum manifests of the images")
+        return set(path for path in paths if old_digests.get(path, '-') == '-' or old_digests.get(path) != new_digests.get(path))
+
+    old_root = old_listing.get_content_root()
+    new_root = new_listing.get_content_root()
+    if (not old_root or not new_root):
+        print(f"Contents of {old_listing.path} or {new_listing.path} can not be read, {len(paths)} files with changed mtimes are reported as modified")
+        return set(paths)
+
+    print(f"Comparing the contents of {len(paths)} files")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        equal_results = executor.map(lambda path: files_are_equal(join(old_root, path), join(new_root, path)), paths)
+        return set(path for path, is_equal in zip(paths, equal_results) if not is_equal)
+
+
+def diff_listings(old_listing, new_listing, compare_content=True, workers=4, include_entries=True):
+    start_time = time.monotonic()
+    mtime_resolution_ns = max(old_listing.mtime_resolution_ns, new_listing.mtime_resolution_ns)
+
+    changes = {category: [] for category in diff_categories}
+    dir_totals = {}
+    compare_candidates = []
+    unchanged_count = 0
+
+    # With mtimes in minutes, a file edited to the same size within the same minute looks unchanged,
+    # the checksum manifests of the images (if both exist) still tell it apart
+    digests = None
+    if (compare_content and mtime_resolution_ns > pow(10, 9)):
+        digests = load_listing_digests(old_listing, new_listing)
+        if (digests):
+            print("Listing mtimes are in minutes, unchanged looking files are checked against the checksum manifests")
+
+    for components, old_entry, new_entry in merge_join(old_listing, new_listing):
+        if (new_entry is None):
+            categories = ['removed']
+        elif (old_entry is None):
+            categories = ['added']
+        elif (old_entry == new_entry):
+            # Most entries did not change at all
+            categories = []
+        else:
+            categories = classify_change(old_entry, new_entry, mtime_resolution_ns)
+
+        if (len(categories) <= 0 and digests and stat.S_ISREG(old_entry[2]) and stat.S_ISREG(new_entry[2])):
+            path = os.fsdecode(b'/'.join(components))
+            old_digest, new_digest = digests[0].get(path, '-'), digests[1].get(path, '-')
+            # '-' are files that could not be hashed
+            if ('-' not in [old_digest, new_digest] and old_digest != new_digest):
+                categories = ['modified']
+
+        if (len(categories) <= 0):
+            unchanged_count += 1
+            continue
+
+        path = os.fsdecode(b'/'.join(components))
+        for category in categories:
+            if (category == 'compare'):
+                compare_candidates.append((path, components, old_entry, new_entry))
+                continue
+
+            add_to_totals(dir_totals, category, components, old_entry, new_entry)
+            if (include_entries):
+                changes[category].append(get_change_record(path, old_entry, new_entry))
+
+    listed_s = time.monotonic() - start_time
+
+    # Content is only read for the few files where the metadata can not tell
+    modified_paths = set(path for path, _, _, _ in compare_candidates)
+    if (compare_content and len(compare_candidates) > 0):
+        modified_paths = compare_contents(old_listing, new_listing, [path for path, _, _, _ in compare_candidates], workers, digests)
+
+    for path, components, old_entry, new_entry in compare_candidates:
+        category = 'modified' if path in modified_paths else 'touched'
+        add_to_totals(dir_totals, category, components, old_entry, new_entry)
+        if (include_entries):
+            changes[category].append(get_change_record(path, old_entry, new_entry))
+
+    summary = new_dir_totals()
+    for totals in dir_totals.values():
+        for key, value in totals.items():
+            summary[key] += value
+    summary['unchanged'] = unchanged_count
+
+    return {
+        'old': old_listing.path,
+        'new': new_listing.path,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'mtime_resolution_s': mtime_resolution_ns / pow(10, 9),
+        'listing_s': round(listed_s, 2),
+        'content_compared': len(compare_candidates) if compare_content else 0,
+        'duration_s': round(time.monotonic() - start_time, 2),
+        'summary': summary,
+        'top_level_dirs': dict(sorted(dir_totals.items())),
+        'changes': changes if include_entries else None,
+    }
+
+
+def print_diff_summary(diff_report):
+    rows = []
+    for top_level_dir, totals in list(diff_report['top_level_dirs'].items()) + [('(total)', diff_report['summary'])]:
+        rows.append({
+            'top_level_dir': top_level_dir,
+            'added': totals['added'],
+            'added_MB': round(totals['added_bytes'] / pow(10, 6), 2),
+            'removed': totals['removed'],
+            'removed_MB': round(totals['removed_bytes'] / pow(10, 6), 2),
+            'modified': totals['modified'],
+            'modified_MB': round(totals['modified_bytes'] / pow(10, 6), 2),
+            'touched': totals['touched'],
+            'permission_changed': totals['permission_changed'],
+            'size_delta_MB': round(totals['size_delta_bytes'] / pow(10, 6), 2),
+        })
+
+    try:
+        pretty_table(rows, diff_table_keys)
+    except ImportError:
+        ugly_print(rows, diff_table_keys)
+
+    print(f"{diff_report['summary']['unchanged']} entries unchanged, {diff_report['content_compared']} files compared by content, {diff_report['duration_s']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the added, removed, modified and permission changed entries between two images (or an image and a dir) from their listings"
+    )
+
+    parser.add_argument('old', help="Older image, compact manifest (.cmanifest) or directory")
+    parser.add_argument('new', help="Newer image, compact manifest (.cmanifest) or directory")
+    parser.add_argument('-o', '--json_output', help="Path to write the diff report to as json ('-' for stdout)", default=None)
+    parser.add_argument('-nc', '--no_content', action="store_true", help="Do not compare contents, files with changed mtimes are reported as modified")
+    parser.add_argument('-so', '--summary_only', action="store_true", help="Only report the totals, without the changed entries")
+    parser.add_argument('-t', '--target', choices=sorted(target_sources.keys()), help="Preconfigured target of the images (like for create_squash_backups), its excludes are applied when listing a directory", default=None)
+    parser.add_argument('-e', '--exclude_filters', nargs='*', help="Additional mksquashfs style wildcard excludes applied when listing a directory", default=[])
+    parser.add_argument('-j', '--jobs', type=int, help="Number of files compared in parallel", default=4)
+
+    args = parser.parse_args()
+
+    for path in [args.old, args.new]:
+        if (not exists(path)):
+            raise Exception(f"{path} does not exist")
+
+    exclude_filters = list(args.exclude_filters)
+    if (args.target):
+        # The source dir of the target is not checked, a restored copy of it can be diffed as well
+        exclude_filters += target_sources[args.target]()[1]
+
+    # With the report on stdout, the progress output goes to stderr so the json stays parseable
+    with redirect_stdout(sys.stderr) if args.json_output == '-' else nullcontext():
+        old_listing = get_listing(args.old, exclude_filters)
+        new_listing = get_listing(args.new, exclude_filters)
+
+        try:
+            diff_report = diff_listings(old_listing, new_listing, compare_content=not args.no_content, workers=args.jobs, include_entries=not args.summary_only)
+        finally:
+            old_listing.close()
+            new_listing.close()
+
+    if (args.json_output == '-'):
+        json.dump(diff_report, sys.stdout, indent=4)
+        return 0
+
+    print_diff_summary(diff_report)
+
+    if (args.json_output):
+        with open(args.json_output, 'w') as json_file:
+            json.dump(diff_report, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
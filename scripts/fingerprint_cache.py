@@ -0,0 +1,266 @@
+import os
+from os.path import exists, join
+import hashlib
+import json
+import stat
+import time
+from checksum_manifest import parse_exclude_filters, is_excluded
+from run_history import history_file_name
+
+# Merkle tree over the stat metadata of the source tree, to skip targets that did not change since the last image
+# Every directory hashes (name, size, mtime, inode, mode) of its files and the hashes of its sub directories
+#
+# Like git's untracked cache, the listing of a directory is reused when the mtime and inode of the directory did not change
+# (creating, removing or renaming an entry always changes the mtime of its directory), which saves the readdir calls.
+# Files still have to be stat'ed, as changing the content of a file in place does not change the mtime of its directory
+
+fingerprints_dir_name = '.fingerprints'
+
+
+def get_fingerprint_cache_path(backups_dir, target):
+    return join(backups_dir, fingerprints_dir_name, f"{target}.json")
+
+
+def load_fingerprint_cache(cache_path):
+    if (not exists(cache_path)):
+        return {}
+
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (json.JSONDecodeError, OSError) as err:
+        print(f"Ignoring unreadable fingerprint cache {cache_path}: {err}")
+        return {}
+
+
+def save_fingerprint_cache(cache_path, fingerprint_cache):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    tmp_cache_path = cache_path + '.tmp'
+    with open(tmp_cache_path, 'w') as cache_file:
+        json.dump(fingerprint_cache, cache_file)
+    os.replace(tmp_cache_path, cache_path)
+
+
+def get_scan_settings_hash(exclude_filters, settings):
+    # A changed exclude list or changed compression settings result in a different image, even with the same source
+    return hashlib.blake2b(json.dumps([sorted(exclude_filters or []), settings]).encode(), digest_size=16).hexdigest()
+
+
+def get_nested_dir_excludes(source_dir, dir_paths):
+    """Anchored excludes of the directories that are inside the source tree
+
+    The backups dir (fingerprint cache, run history, manifests) and the metrics dirs change with every run,
+    when they are part of the source (like for / targets) the fingerprint would never match again
+    """
+    real_source_dir = os.path.realpath(source_dir)
+    nested_excludes = []
+    for dir_path in dir_paths:
+        if (not dir_path):
+            continue
+
+        rel_path = os.path.relpath(os.path.realpath(dir_path), real_source_dir)
+        if (rel_path == os.curdir):
+            # Backups written into the source dir itself, only the bookkeeping entries can be left out
+            nested_excludes += [fingerprints_dir_name, history_file_name]
+        elif (rel_path != os.pardir and not rel_path.startswith(os.pardir + os.sep)):
+            nested_excludes.append(rel_path)
+
+    return nested_excludes
+
+
+def list_dir(dir_path, rel_dir, parsed_filters):
+    file_names = []
+    dir_names = []
+    for entry in os.scandir(dir_path):
+        entry_components = (rel_dir.split('/') if rel_dir else []) + [entry.name]
+        if (is_excluded(entry_components, parsed_filters)):
+            continue
+
+        if (entry.is_dir(follow_symlinks=False)):
+            dir_names.append(entry.name)
+        else:
+            file_names.append(entry.name)
+
+    return sorted(file_names), sorted(dir_names)
+
+
+class StatTreeScan():
+    """Computes the fingerprints of all directories of a source tree, reusing unchanged directory listings of a previous scan"""
+
+    def __init__(self, source_dir, exclude_filters=None, previous_dirs=None):
+        self.source_dir = source_dir
+        self.parsed_filters = parse_exclude_filters(exclude_filters)
+        self.previous_dirs = previous_dirs or {}
+        self.dirs = {}
+        self.reused_listings = 0
+
+    def scan_dir(self, rel_dir):
+        dir_path = join(self.source_dir, rel_dir) if rel_dir else self.source_dir
+        dir_stat = os.lstat(dir_path)
+
+        previous_dir = self.previous_dirs.get(rel_dir)
+        if (previous_dir and previous_dir['mtime_ns'] == dir_stat.st_mtime_ns and previous_dir['ino'] == dir_stat.st_ino):
+            file_names, dir_names = previous_dir['files'], previous_dir['dirs']
+            self.reused_listings += 1
+        else:
+            try:
+                file_names, dir_names = list_dir(dir_path, rel_dir, self.parsed_filters)
+            except PermissionError as err:
+                print(f"Can not read directory for fingerprint: {err}")
+                file_names, dir_names = [], []
+
+        hasher = hashlib.blake2b(digest_size=16)
+        tree_size = 0
+        file_count = 0
+
+        for file_name in file_names:
+            try:
+                file_stat = os.lstat(join(dir_path, file_name))
+            except FileNotFoundError:
+                # Removed within the mtime granularity of the directory, the listing is refreshed with the next scan
+                continue
+
+            hasher.update(f"f\0{file_name}\0{file_stat.st_size}\0{file_stat.st_mtime_ns}\0{file_stat.st_ino}\0{file_stat.st_mode}\n".encode('utf-8', 'surrogateescape'))
+            if (stat.S_ISREG(file_stat.st_mode)):
+                tree_size += file_stat.st_size
+            file_count += 1
+
+        for dir_name in dir_names:
+            sub_rel_dir = f"{rel_dir}/{dir_name}" if rel_dir else dir_name
+            try:
+                sub_dir = self.scan_dir(sub_rel_dir)
+            except FileNotFoundError:
+                continue
+
+            hasher.update(f"d\0{dir_name}\0{sub_dir['mode']}\0{sub_dir['hash']}\n".encode('utf-8', 'surrogateescape'))
+            tree_size += sub_dir['size']
+            file_count += sub_dir['file_count']
+
+        scanned_dir = {
+            'mtime_ns': dir_stat.st_mtime_ns,
+            'ino': dir_stat.st_ino,
+            'mode': dir_stat.st_mode,
+            'files': file_names,
+            'dirs': dir_names,
+            'hash': hasher.hexdigest(),
+            # Sizes of the whole sub tree, reused as source size for predictions
+            'size': tree_size,
+            'file_count': file_count,
+        }
+        self.dirs[rel_dir] = scanned_dir
+
+        return scanned_dir
+
+    def scan(self):
+        return self.scan_dir('')
+
+
+def get_source_fingerprint(cache_path, source_dir, exclude_filters, settings):
+    """Scans the source and returns (root fingerprint, total size, file count, fingerprint cache with the new tree)"""
+    fingerprint_cache = load_fingerprint_cache(cache_path)
+    settings_hash = get_scan_settings_hash(exclude_filters, settings)
+
+    previous_dirs = fingerprint_cache.get('dirs') if fingerprint_cache.get('settings_hash') == settings_hash else None
+
+    start_time = time.monotonic()
+    tree_scan = StatTreeScan(source_dir, exclude_filters, previous_dirs)
+    root_dir = tree_scan.scan()
+
+    print(f"Fingerprint of {source_dir}: {root_dir['hash']} ({len(tree_scan.dirs)} dirs, {tree_scan.reused_listings} unchanged listings reused, {round(time.monotonic() - start_time, 2)}s)")
+
+    fingerprint_cache['settings_hash'] = settings_hash
+    fingerprint_cache['dirs'] = tree_scan.dirs
+
+    root_fingerprint = hashlib.blake2b(f"{settings_hash}\0{root_dir['hash']}".encode(), digest_size=16).hexdigest()
+
+    return root_fingerprint, root_dir['size'], root_dir['file_count'], fingerprint_cache
+
+
+def get_cached_tree_size(source_dir, rel_dir, parsed_filters, previous_dirs):
+    """(size, file count) of a sub tree, the files of directories whose mtime and inode did not change are not stat'ed again
+
+    Sizes of files changed in place are not noticed, which is good enough for predictions, never for fingerprints
+    """
+    dir_path = join(source_dir, rel_dir) if rel_dir else source_dir
+    dir_stat = os.lstat(dir_path)
+
+    tree_size = 0
+    file_count = 0
+
+    previous_dir = previous_dirs.get(rel_dir)
+    if (previous_dir and previous_dir['mtime_ns'] == dir_stat.st_mtime_ns and previous_dir['ino'] == dir_stat.st_ino):
+        dir_names = previous_dir['dirs']
+        # The cached sizes are of the whole sub tree, the sub directories are added by their own (possibly changed) sizes
+        previous_sub_dirs = [previous_dirs.get(f"{rel_dir}/{dir_name}" if rel_dir else dir_name, {}) for dir_name in dir_names]
+        tree_size += previous_dir['size'] - sum(sub_dir.get('size', 0) for sub_dir in previous_sub_dirs)
+        file_count += previous_dir['file_count'] - sum(sub_dir.get('file_count', 0) for sub_dir in previous_sub_dirs)
+    else:
+        try:
+            file_names, dir_names = list_dir(dir_path, rel_dir, parsed_filters)
+        except PermissionError as err:
+            print(f"Can not read directory for source size: {err}")
+            file_names, dir_names = [], []
+
+        for file_name in file_names:
+            try:
+                file_stat = os.lstat(join(dir_path, file_name))
+            except FileNotFoundError:
+                continue
+
+            if (stat.S_ISREG(file_stat.st_mode)):
+                tree_size += file_stat.st_size
+            file_count += 1
+
+    for dir_name in dir_names:
+        try:
+            sub_size, sub_count = get_cached_tree_size(source_dir, f"{rel_dir}/{dir_name}" if rel_dir else dir_name, parsed_filters, previous_dirs)
+        except FileNotFoundError:
+            continue
+
+        tree_size += sub_size
+        file_count += sub_count
+
+    return tree_size, file_count
+
+
+def get_cached_source_size(cache_path, source_dir, exclude_filters, settings):
+    """Size and file count of the source for predictions, reusing the sizes of the last fingerprint scan of unchanged directories"""
+    fingerprint_cache = load_fingerprint_cache(cache_path)
+    previous_dirs = fingerprint_cache.get('dirs') if fingerprint_cache.get('settings_hash') == get_scan_settings_hash(exclude_filters, settings) else None
+
+    return get_cached_tree_size(source_dir, '', parse_exclude_filters(exclude_filters), previous_dirs or {})
+
+
+def get_dir_content_hash(dir_path):
+    """Hash of the paths and contents of all files of a (small) directory, like the generated package lists"""
+    hasher = hashlib.blake2b(digest_size=16)
+    for current_dir_path, _, file_names in sorted(os.walk(dir_path)):
+        for file_name in sorted(file_names):
+            file_path = join(current_dir_path, file_name)
+            hasher.update(os.path.relpath(file_path, dir_path).encode('utf-8', 'surrogateescape') + b'\0')
+            with open(file_path, 'rb') as hashed_file:
+                hasher.update(hashed_file.read())
+
+    return hasher.hexdigest()
+
+
+def get_unchanged_image(fingerprint_cache, root_fingerprint):
+    """Path of the last successfully created image, if the source did not change since it was created"""
+    last_image = fingerprint_cache.get('last_image')
+
+    if (not last_image or last_image.get('fingerprint') != root_fingerprint):
+        return None
+
+    if (not exists(last_image['path'])):
+        return None
+
+    return last_image['path']
+
+
+def set_last_image(fingerprint_cache, root_fingerprint, image_path):
+    fingerprint_cache['last_image'] = {
+        'fingerprint': root_fingerprint,
+        'path': image_path,
+        'timestamp': time.time(),
+    }
@@ -0,0 +1,184 @@
+import os
+from os.path import isfile, join
+import hashlib
+import shlex
+import shutil
+import stat
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Lists of the installed packages of the system package managers, stored in the image instead of the package payloads
+# (usr/, var/lib/dpkg, var/lib/flatpak, snaps) that can be reinstalled from the lists with restore_packages.py
+# Package files that were changed locally (dpkg --verify) are checksummed and the ones outside of the backed up dirs are copied
+
+# Name of the directory in the root of the image that contains the lists
+packages_dir_name = 'backup-packages'
+
+modified_files_dir_name = 'modified'
+
+# mode, uid, gid and path of the copied modified files, the copies themselves do not keep the owner
+modified_files_modes_name = 'modified-files.modes'
+
+# command, file name of the output in the packages dir
+package_list_commands = {
+    'dpkg': [
+        (['dpkg', '--get-selections'], 'dpkg.selections'),
+        (['dpkg-query', '-W', '-f=${Package}\t${Version}\t${Architecture}\n'], 'dpkg.versions'),
+    ],
+    'apt-mark': [
+        (['apt-mark', 'showmanual'], 'apt.manual'),
+    ],
+    'apt-cache': [
+        # Third party repositories are in /etc/apt (backed up anyway), the policy shows which repository a package came from
+        (['apt-cache', 'policy'], 'apt.policy'),
+    ],
+    'flatpak': [
+        (['flatpak', 'remotes', '--columns=name,url,options'], 'flatpak.remotes'),
+        (['flatpak', 'list', '--app', '--columns=application,origin,branch,installation'], 'flatpak.apps'),
+    ],
+    'snap': [
+        (['snap', 'list'], 'snap.list'),
+    ],
+}
+
+
+def run_list_command(cmd, output_path):
+    print(" ".join(cmd))
+    list_process = subprocess.run(cmd, capture_output=True, text=True)
+
+    if (list_process.returncode != 0):
+        print(f"Command {' '.join(cmd)} failed: {list_process.stderr.strip()}")
+        return None
+
+    with open(output_path, 'w') as output_file:
+        output_file.write(list_process.stdout)
+
+    return output_path
+
+
+def sha256_file(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+# dpkg --verify prints lines like '??5??????   /usr/share/foo' or '??5?????? c /etc/foo.conf'
+# The third character is '5' when the checksum of the file does not match the one of the package
+def get_modified_package_files():
+    if (not shutil.which('dpkg')):
+        return []
+
+    print("dpkg --verify")
+    verify_process = subprocess.run(['dpkg', '--verify'], capture_output=True, text=True)
+
+    modified_files = []
+    for line in verify_process.stdout.splitlines():
+        if (len(line) <= 12 or line[2] != '5'):
+            continue
+        modified_files.append(line[12:])
+
+    return modified_files
+
+
+def is_in_backed_up_dirs(file_path, backed_up_dirs):
+    return any(file_path == backed_up_dir or file_path.startswith(backed_up_dir.rstrip('/') + '/') for backed_up_dir in backed_up_dirs)
+
+
+def collect_modified_files(packages_dir, backed_up_dirs):
+    """Writes checksums of locally modified package files and copies the ones that are not backed up with the image anyway"""
+    modified_files = get_modified_package_files()
+
+    checksum_lines = []
+    mode_lines = []
+    for modified_file in modified_files:
+        if (not isfile(modified_file)):
+            continue
+
+        checksum_lines.append(f"{sha256_file(modified_file)}  {modified_file}")
+
+        if (not is_in_backed_up_dirs(modified_file, backed_up_dirs)):
+            copy_path = join(packages_dir, modified_files_dir_name, modified_file.lstrip('/'))
+            os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+            shutil.copy2(modified_file, copy_path)
+
+            file_stat = os.lstat(modified_file)
+            mode_lines.append(f"{stat.S_IMODE(file_stat.st_mode):o}\t{file_stat.st_uid}\t{file_stat.st_gid}\t{modified_file}")
+
+    with open(join(packages_dir, modified_files_modes_name), 'w') as modes_file:
+        modes_file.write("\n".join(mode_lines) + "\n")
+
+    # sha256sum compatible, 'sha256sum -c modified-files.sha256' shows which files differ after restoring the packages
+    checksums_path = join(packages_dir, 'modified-files.sha256')
+    with open(checksums_path, 'w') as checksums_file:
+        checksums_file.write("\n".join(checksum_lines) + "\n")
+
+    return checksums_path
+
+
+def collect_package_manifests(generated_dir, backed_up_dirs, workers=4):
+    """Gathers the package lists of all available package managers in parallel into '<generated_dir>/backup-packages'"""
+    packages_dir = join(generated_dir, packages_dir_name)
+    os.makedirs(packages_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for tool, commands in package_list_commands.items():
+            if (not shutil.which(tool)):
+                print(f"{tool} is not installed, skipping its package list")
+                continue
+
+            for cmd, file_name in commands:
+                futures.append(executor.submit(run_list_command, cmd, join(packages_dir, file_name)))
+
+        # dpkg --verify reads every file of every package, which takes the longest
+        futures.append(executor.submit(collect_modified_files, packages_dir, backed_up_dirs))
+
+        generated_files = [future.result() for future in futures]
+
+    return packages_dir, [generated_file for generated_file in generated_files if generated_file]
+
+
+def escape_pseudo_name(name):
+    return name.replace('\\', '\\\\').replace(' ', '\\ ')
+
+
+def get_original_path(generated_dir, rel_path):
+    """Path of the file a generated file was copied from (modified package files), otherwise the generated file itself"""
+    modified_files_dir = join(packages_dir_name, modified_files_dir_name)
+    if (rel_path.startswith(modified_files_dir + '/')):
+        original_path = '/' + rel_path[len(modified_files_dir) + 1:]
+        if (os.path.lexists(original_path)):
+            return original_path
+
+    return join(generated_dir, rel_path)
+
+
+def get_pseudo_attributes(generated_dir, rel_path):
+    # Mode and owner of the original, so restoring a copy of for example /usr/bin/foo keeps it executable
+    original_stat = os.lstat(get_original_path(generated_dir, rel_path))
+    return f"{stat.S_IMODE(original_stat.st_mode):o} {original_stat.st_uid} {original_stat.st_gid}"
+
+
+def write_pseudo_definitions(generated_dir, definitions_path):
+    """mksquashfs pseudo file definitions (-pf) adding all files of generated_dir to the root of the image"""
+    definitions = []
+    for dir_path, dir_names, file_names in os.walk(generated_dir):
+        dir_names.sort()
+        rel_dir_path = os.path.relpath(dir_path, generated_dir)
+
+        if (rel_dir_path != '.'):
+            definitions.append(f"{escape_pseudo_name(rel_dir_path)} d {get_pseudo_attributes(generated_dir, rel_dir_path)}")
+
+        for file_name in sorted(file_names):
+            file_path = join(dir_path, file_name)
+            rel_file_path = os.path.relpath(file_path, generated_dir)
+            # The output of the command becomes the content of the pseudo file
+            definitions.append(f"{escape_pseudo_name(rel_file_path)} f {get_pseudo_attributes(generated_dir, rel_file_path)} cat {shlex.quote(file_path)}")
+
+    with open(definitions_path, 'w') as definitions_file:
+        definitions_file.write("\n".join(definitions) + "\n")
+
+    return definitions_path
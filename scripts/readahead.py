@@ -0,0 +1,165 @@
+import os
+import struct
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from backup_metrics import get_process_tree_read_position, is_process_running
+from checksum_manifest import parse_exclude_filters, walk_source_tree
+
+# On spinning disks a tree with many small files is seek bound: mksquashfs reads the files in directory order,
+# which is scattered over the disk. This reads ahead of mksquashfs in a bounded window and sorts the files of a window
+# by their physical position on the disk, so the head moves (mostly) in one direction and mksquashfs reads from the page cache
+
+# https://www.kernel.org/doc/html/latest/filesystems/fiemap.html
+FS_IOC_FIEMAP = 0xC020660B
+fiemap_header_format = '=QQLLLL'
+fiemap_extent_format = '=QQQQQLLLL'
+fiemap_header_size = struct.calcsize(fiemap_header_format)
+fiemap_extent_size = struct.calcsize(fiemap_extent_format)
+
+min_window_bytes = 16 * pow(2, 20)
+
+
+def get_physical_offset(file_path):
+    """Physical byte offset of the first extent of a file, None if the filesystem does not support FIEMAP"""
+    # Only the first extent is requested, it decides where the disk head has to go first
+    request = bytearray(struct.pack(fiemap_header_format, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(fiemap_extent_size))
+
+    try:
+        with open(file_path, 'rb') as mapped_file:
+            fcntl.ioctl(mapped_file.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+
+    mapped_extents = struct.unpack_from(fiemap_header_format, request)[3]
+    if (mapped_extents <= 0):
+        # Empty files or data inlined into the inode
+        return None
+
+    return struct.unpack_from(fiemap_extent_format, request, fiemap_header_size)[1]
+
+
+def get_read_order_key(file_entry):
+    file_path, inode, _ = file_entry
+    physical_offset = get_physical_offset(file_path)
+
+    # Files without extents are sorted after the mapped files by inode number, which on most filesystems
+    # correlates with the allocation order and therefore roughly with the position on the disk
+    if (physical_offset is None):
+        return (1, inode)
+
+    return (0, physical_offset)
+
+
+def warm_file(file_path):
+    try:
+        file_descriptor = os.open(file_path, os.O_RDONLY | os.O_NOATIME)
+    except PermissionError:
+        # O_NOATIME is only allowed for the owner of the file or root
+        try:
+            file_descriptor = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            return
+    except OSError:
+        return
+
+    try:
+        # Starts the readahead of the whole file into the page cache
+        os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(file_descriptor)
+
+
+def get_available_memory_bytes():
+    with open('/proc/meminfo', 'r') as meminfo_file:
+        for line in meminfo_file:
+            if (line.startswith('MemAvailable:')):
+                return int(line.split()[1]) * 1024
+
+    return None
+
+
+class ReadAhead(threading.Thread):
+    """Warms the page cache in physical disk order, a bounded window ahead of the reading process"""
+
+    def __init__(self, source_dir, exclude_filters=None, reader_pid=None, max_window_bytes=512 * pow(2, 20), cache_fraction=0.25, workers=4, poll_interval=0.1):
+        super().__init__(daemon=True)
+        self.source_dir = source_dir
+        self.exclude_filters = list(exclude_filters or [])
+        self.reader_pid = reader_pid
+        self.max_window_bytes = max_window_bytes
+        # At most this fraction of the available memory is filled ahead of the reader, so pages are not evicted before they are read
+        self.cache_fraction = cache_fraction
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.warmed_bytes = 0
+        self.warmed_files = 0
+
+    def get_window_bytes(self):
+        available_bytes = get_available_memory_bytes()
+        if (not available_bytes):
+            return self.max_window_bytes
+
+        return max(min_window_bytes, min(self.max_window_bytes, int(available_bytes * self.cache_fraction)))
+
+    def get_reader_position(self):
+        if (not self.reader_pid):
+            # Without a reader the window only limits the size of the sorted batches
+            return self.warmed_bytes
+
+        # rchar also counts reads served from the page cache, which is what mksquashfs does once the readahead is in front of it
+        # None if the io counters are not readable (sudo mksquashfs while this does not run as root)
+        return get_process_tree_read_position(self.reader_pid)
+
+    def is_reader_running(self):
+        # A zombie (exited but not yet reaped by run_sampled) still has its /proc entry
+        return not self.reader_pid or is_process_running(self.reader_pid)
+
+    def iter_files(self):
+        for _, entry in walk_source_tree(self.source_dir, parse_exclude_filters(self.exclude_filters)):
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if (entry.is_file(follow_symlinks=False) and entry_stat.st_size > 0):
+                yield entry.path, entry_stat.st_ino, entry_stat.st_size
+
+    def run(self):
+        files = self.iter_files()
+        pending_file = next(files, None)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while (pending_file and not self.stop_event.is_set() and self.is_reader_running()):
+                reader_position = self.get_reader_position()
+                if (reader_position is None):
+                    # Without the position of the reader the window would never move and the read ahead would stall after the first window
+                    print("Can not read the io counters of the reading process (requires root), stopping the read ahead")
+                    break
+
+                window_end = reader_position + self.get_window_bytes()
+
+                batch = []
+                batch_bytes = 0
+                while (pending_file and self.warmed_bytes + batch_bytes < window_end):
+                    batch.append(pending_file)
+                    batch_bytes += pending_file[2]
+                    pending_file = next(files, None)
+
+                if (len(batch) <= 0):
+                    # Window is full, wait for the reader to catch up
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+
+                batch.sort(key=get_read_order_key)
+                # map returns in submission order, which waits for the whole batch before the next window is planned
+                list(executor.map(warm_file, [file_path for file_path, _, _ in batch]))
+
+                self.warmed_bytes += batch_bytes
+                self.warmed_files += len(batch)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        print(f"Read ahead warmed {self.warmed_files} files ({round(self.warmed_bytes / pow(10, 6))}MB)")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import exists, isdir, join
+import argparse
+import shlex
+import shutil
+import sys
+from package_manifests import packages_dir_name, modified_files_dir_name, modified_files_modes_name
+
+# Reinstalls the packages listed in the 'backup-packages' dir of an image created with the 'sys_packages' target
+# The image needs to be mounted (or extracted) first, for example with mount_squashfs_image
+
+
+def read_lines(file_path):
+    if (not exists(file_path)):
+        return []
+
+    with open(file_path, 'r') as list_file:
+        return [line.rstrip('\n') for line in list_file if len(line.strip()) > 0]
+
+
+def get_apt_restore_cmds(packages_dir):
+    cmds = []
+
+    manual_packages = read_lines(join(packages_dir, 'apt.manual'))
+    if (len(manual_packages) > 0):
+        cmds.append("sudo apt-get update")
+        # Only the manually installed packages, their dependencies are marked as automatically installed again
+        cmds.append("sudo apt-get install -y " + " ".join(shlex.quote(package) for package in manual_packages))
+    elif (exists(join(packages_dir, 'dpkg.selections'))):
+        cmds.append("sudo apt-get update")
+        cmds.append(f"sudo dpkg --set-selections < {shlex.quote(join(packages_dir, 'dpkg.selections'))}")
+        cmds.append("sudo apt-get dselect-upgrade -y")
+
+    return cmds
+
+
+def get_flatpak_restore_cmds(packages_dir):
+    cmds = []
+
+    # Columns: name, url, options
+    for line in read_lines(join(packages_dir, 'flatpak.remotes')):
+        columns = line.split('\t')
+        if (len(columns) < 2):
+            continue
+        installation = '--user' if len(columns) > 2 and 'user' in columns[2] else '--system'
+        cmds.append(f"flatpak remote-add --if-not-exists {installation} {shlex.quote(columns[0])} {shlex.quote(columns[1])}")
+
+    # Columns: application, origin, branch, installation
+    for line in read_lines(join(packages_dir, 'flatpak.apps')):
+        columns = line.split('\t')
+        if (len(columns) < 4):
+            continue
+        application, origin, branch, installation = columns[:4]
+        cmds.append(f"flatpak install -y --{installation} {shlex.quote(origin)} {shlex.quote(application + '//' + branch)}")
+
+    return cmds
+
+
+def get_snap_restore_cmds(packages_dir):
+    cmds = []
+
+    # Output of 'snap list': Name Version Rev Tracking Publisher Notes
+    snap_lines = read_lines(join(packages_dir, 'snap.list'))
+    for line in snap_lines[1:]:
+        columns = line.split()
+        if (len(columns) < 4):
+            continue
+        name, tracking = columns[0], columns[3]
+        notes = columns[5] if len(columns) > 5 else ''
+
+        # Base snaps and snapd are installed together with the snaps that need them
+        if (name == 'snapd' or 'base' in notes.split(',')):
+            continue
+
+        cmd = f"sudo snap install {shlex.quote(name)} --channel={shlex.quote(tracking)}"
+        if ('classic' in notes.split(',')):
+            cmd += " --classic"
+        cmds.append(cmd)
+
+    return cmds
+
+
+def read_modified_file_modes(packages_dir):
+    file_modes = {}
+    for line in read_lines(join(packages_dir, modified_files_modes_name)):
+        mode, uid, gid, file_path = line.split('\t', 3)
+        file_modes[file_path] = (mode, uid, gid)
+
+    return file_modes
+
+
+def get_modified_files_restore_cmds(packages_dir):
+    modified_files_dir = join(packages_dir, modified_files_dir_name)
+    if (not isdir(modified_files_dir)):
+        return []
+
+    file_modes = read_modified_file_modes(packages_dir)
+
+    # Installs the locally modified package files back over the ones of the reinstalled packages, one by one with their recorded
+    # mode and owner. Only files are restored, existing parent directories keep their mode and owner (install -D only creates missing ones)
+    cmds = []
+    for dir_path, dir_names, file_names in os.walk(modified_files_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            copy_path = join(dir_path, file_name)
+            target_path = '/' + os.path.relpath(copy_path, modified_files_dir)
+
+            if (target_path not in file_modes):
+                # Guessing the mode and owner could install a secret world readable or a config owned by the wrong user
+                raise Exception(f"No mode and owner recorded for modified file '{target_path}' in {join(packages_dir, modified_files_modes_name)}")
+
+            mode, uid, gid = file_modes[target_path]
+            cmds.append(f"sudo install -D -m {mode} -o {uid} -g {gid} {shlex.quote(copy_path)} {shlex.quote(target_path)}")
+
+    return cmds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reinstall the packages listed in a mounted or extracted package manifest backup"
+    )
+
+    parser.add_argument('-dry', '--dry_run', action="store_true", help="Do not commit any changes to the system, only print what would be changed")
+    parser.add_argument('image_root', help="Root directory of the mounted or extracted image (contains the 'backup-packages' dir)")
+    parser.add_argument('-m', '--managers', nargs='+', choices=['apt', 'flatpak', 'snap', 'modified'], help="Package managers to restore the packages of", default=['apt', 'flatpak', 'snap', 'modified'])
+
+    args = parser.parse_args()
+
+    packages_dir = join(args.image_root, packages_dir_name)
+    if (not isdir(packages_dir)):
+        raise Exception(f"No package lists found at '{packages_dir}'")
+
+    restore_cmd_getters = {
+        'apt': get_apt_restore_cmds,
+        'flatpak': get_flatpak_restore_cmds,
+        'snap': get_snap_restore_cmds,
+        'modified': get_modified_files_restore_cmds,
+    }
+
+    for manager in args.managers:
+        for cmd in restore_cmd_getters[manager](packages_dir):
+            print(cmd)
+
+            if (args.dry_run):
+                continue
+
+            tool = cmd.replace('sudo ', '', 1).split()[0]
+            if (not shutil.which(tool)):
+                print(f"{tool} is not installed, skipping")
+                break
+
+            if (os.system(cmd) != 0):
+                print(f"Command failed: {cmd}")
+
+    if (exists(join(packages_dir, 'modified-files.sha256'))):
+        print(f"\nCheck the restored locally modified files with: sha256sum -c {join(packages_dir, 'modified-files.sha256')}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
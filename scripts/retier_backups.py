@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import exists, isdir, join
+import argparse
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from datetime import datetime
+from archive_backends import TarZstdBackend, get_backend_for_image
+from benchmark_mksquashfs import comp_algorithms
+from checksum_manifest import get_manifest_path, read_manifest, write_manifest
+from compact_manifest import merge_join
+from diff_backups import get_listing
+from run_history import get_host_load
+from squashfs_mount import mount_squashfs_image, umount_mount, verify_squashfs
+
+# Daily images are created fast (low compression level) to keep the backup window short
+# Once they reached a certain age they are recompressed with a stronger profile while the machine is idle
+# The new image is verified before it replaces the old one, its name only differs in the settings string
+
+# Compression options of the profiles, have to be valid options of the 'comp_algorithms' table
+retier_profiles = {
+    'zstd19': {'comp': 'zstd', '-Xcompression-level': 19},
+    'zstd22': {'comp': 'zstd', '-Xcompression-level': 22},
+    'xz': {'comp': 'xz'},
+    # The x86 BCJ filter improves the compression of executables and libraries (system images)
+    'xz_x86': {'comp': 'xz', '-Xbcj': 'x86'},
+}
+
+block_size = "256k"
+
+# label__source-DD-MM-YYYY-<settings>.<extension>
+image_name_regex = re.compile(r'^(?P<prefix>.*-(?P<date>\d{2}-\d{2}-\d{4}))-(?P<settings>c_[^.]+)(?P<extension>\.squash\.img|\.tar\.zst)$')
+
+retier_tmp_prefix = '.retier-'
+
+
+def validate_profile(profile_name):
+    profile = retier_profiles[profile_name]
+    comp_algo = profile['comp']
+
+    for option, value in profile.items():
+        if (option == 'comp'):
+            continue
+        if (value not in comp_algorithms[comp_algo].get(option, [])):
+            raise Exception(f"Option {option} {value} of profile {profile_name} is not valid for {comp_algo}")
+
+    return profile
+
+
+def get_profile_settings_string(profile, extension):
+    if (extension == TarZstdBackend.extension):
+        return TarZstdBackend().get_settings_string(profile['-Xcompression-level'])
+
+    settings_string = f"c_{profile['comp']}-b_{block_size}"
+    if ('-Xcompression-level' in profile):
+        settings_string += f"-l_{profile['-Xcompression-level']}"
+    if ('-Xbcj' in profile):
+        settings_string += f"-bcj_{profile['-Xbcj']}"
+
+    return settings_string
+
+
+def get_profile_options(profile):
+    options = ['-comp', profile['comp'], '-b', block_size]
+    for option, value in profile.items():
+        if (option != 'comp'):
+            options += [option, str(value)]
+
+    return options
+
+
+def get_compression_level(settings_string):
+    level_match = re.search(r'-l_(\d+)', settings_string)
+    if (not level_match):
+        return None
+
+    return int(level_match.group(1))
+
+
+def is_stronger_or_equal(settings_string, profile):
+    """Whether an image was already created with the profile or a stronger level of the same compressor"""
+    if (not settings_string.startswith(f"c_{profile['comp']}-")):
+        return False
+
+    current_level = get_compression_level(settings_string)
+    profile_level = profile.get('-Xcompression-level')
+
+    if (current_level is None or profile_level is None):
+        return '-bcj_' in settings_string or '-Xbcj' not in profile
+
+    return current_level >= profile_level
+
+
+def get_image_age_days(image_path, date_string):
+    try:
+        image_date = datetime.strptime(date_string, "%d-%m-%Y")
+        return (datetime.now() - image_date).days
+    except ValueError:
+        return (time.time() - os.stat(image_path).st_mtime) / (24 * 60 * 60)
+
+
+def find_retier_candidates(backups_dir, min_age_days, profile_name, system_profile_name):
+    candidates = []
+    for file_name in sorted(os.listdir(backups_dir)):
+        name_match = image_name_regex.match(file_name)
+        if (not name_match or file_name.startswith(retier_tmp_prefix)):
+            continue
+
+        image_path = join(backups_dir, file_name)
+        if (get_image_age_days(image_path, name_match.group('date')) < min_age_days):
+            continue
+
+        # Images of the system targets contain mostly executables and libraries
+        chosen_profile_name = profile_name
+        if (system_profile_name and (file_name.startswith('sys') or '__system-' in file_name or file_name.startswith('system-'))):
+            chosen_profile_name = system_profile_name
+
+        profile = retier_profiles[chosen_profile_name]
+        extension = name_match.group('extension')
+
+        if (extension == TarZstdBackend.extension and profile['comp'] != 'zstd'):
+            # Tar archives are only recompressed, they stay zstd
+            continue
+
+        if (is_stronger_or_equal(name_match.group('settings'), profile)):
+            continue
+
+        new_file_name = f"{name_match.group('prefix')}-{get_profile_settings_string(profile, extension)}{extension}"
+        candidates.append((image_path, join(backups_dir, new_file_name), chosen_profile_name))
+
+    return candidates
+
+
+def wait_until_idle(max_load, max_wait_s, poll_interval_s=60):
+    waited_s = 0
+    while (get_host_load() > max_load):
+        if (waited_s >= max_wait_s):
+            return False
+        print(f"Host load {get_host_load()} is above {max_load}, waiting for the machine to be idle")
+        time.sleep(poll_interval_s)
+        waited_s += poll_interval_s
+
+    return True
+
+
+# Idle cpu and io scheduling class, so that recompression does not slow down anything else running on the machine
+idle_priority_cmd = "nice -n 19 ionice -c 3"
+
+
+def run_pipeline(reader_cmd, writer_cmd):
+    """Runs 'reader | writer', successful only if both succeed (a failing reader would otherwise leave a truncated, valid image)"""
+    print(f"{' '.join(reader_cmd)} | {' '.join(writer_cmd)}")
+    reader_process = subprocess.Popen(reader_cmd, stdout=subprocess.PIPE)
+    writer_process = subprocess.Popen(writer_cmd, stdin=reader_process.stdout)
+    # Only the writer holds the pipe, so the reader gets SIGPIPE if the writer exits early
+    reader_process.stdout.close()
+
+    writer_return_code = writer_process.wait()
+    reader_return_code = reader_process.wait()
+
+    if (reader_return_code != 0 or writer_return_code != 0):
+        print(f"Recompression failed (reader exit status {reader_return_code}, writer exit status {writer_return_code})")
+        return False
+
+    return True
+
+
+def rebuild_squashfs_image(image_path, tmp_image_path, profile):
+    profile_options = get_profile_options(profile)
+    idle_priority_args = idle_priority_cmd.split()
+
+    if (shutil.which('sqfs2tar')):
+        # Streams the files of the old image as tar directly into mksquashfs (requires squashfs-tools >= 4.6 for -tar)
+        reader_cmd = idle_priority_args + ['sqfs2tar', image_path]
+        writer_cmd = ['sudo'] + idle_priority_args + ['mksquashfs', '-', tmp_image_path, '-tar'] + profile_options + ['-mem', '1200M', '-info', '-noappend']
+        return run_pipeline(reader_cmd, writer_cmd)
+
+    # Without squashfs-tools-ng the old image is mounted and read by mksquashfs through the mount
+    mount_dir = mount_squashfs_image(image_path, os.path.basename(tmp_image_path), show_usage=False)
+    try:
+        cmd = f"sudo {idle_priority_cmd} mksquashfs '{mount_dir}' '{tmp_image_path}' {' '.join(profile_options)} -mem 1200M -info -noappend"
+        print(cmd)
+        return os.system(cmd) == 0
+    finally:
+        umount_mount(mount_dir)
+
+
+def recompress_tar_image(image_path, tmp_image_path, profile):
+    # The window the archive was created with (from its name), the new archive uses the default window its name states
+    old_backend = get_backend_for_image(image_path)
+    new_backend = TarZstdBackend()
+    idle_priority_args = idle_priority_cmd.split()
+
+    # The tar stream does not need to be unpacked, only the zstd frames are recompressed
+    reader_cmd = idle_priority_args + ['zstd', '-dc', f"--long={old_backend.long_window_log}", image_path]
+    writer_cmd = idle_priority_args + ['zstd', '-q'] + new_backend.get_zstd_options(profile['-Xcompression-level']) + ['-f', '-o', tmp_image_path]
+    return run_pipeline(reader_cmd, writer_cmd)
+
+
+def is_entry_equal(old_entry, new_entry):
+    old_size, old_mtime_ns, old_mode, old_owner, old_link = old_entry
+    new_size, new_mtime_ns, new_mode, new_owner, new_link = new_entry
+
+    if (stat.S_ISDIR(old_mode) and stat.S_ISDIR(new_mode)):
+        # The listed size of a directory is the size of its directory table, which depends on the layout of the image
+        return old_mode == new_mode and old_owner == new_owner
+
+    return old_entry == new_entry
+
+
+def listings_match(image_path, new_image_path, max_printed=10):
+    """Whether the new image lists exactly the same entries (type, mode, owner, size, mtime, link) as the old one"""
+    mismatch_count = 0
+    entry_count = 0
+    for components, old_entry, new_entry in merge_join(get_listing(image_path), get_listing(new_image_path)):
+        entry_count += 1
+        if (old_entry is not None and new_entry is not None and is_entry_equal(old_entry, new_entry)):
+            continue
+
+        mismatch_count += 1
+        if (mismatch_count <= max_printed):
+            print(f"Entry differs between the images: {os.fsdecode(b'/'.join(components))} {old_entry} != {new_entry}")
+
+    if (mismatch_count > 0):
+        print(f"{mismatch_count} of {entry_count} entries differ between {image_path} and {new_image_path}")
+        return False
+
+    print(f"All {entry_count} entries of {image_path} are in {new_image_path}")
+    return True
+
+
+def update_manifest(image_path, new_image_path):
+    manifest_path = get_manifest_path(image_path)
+    if (not exists(manifest_path)):
+        return
+
+    header, entries = read_manifest(manifest_path)
+    write_manifest(get_manifest_path(new_image_path), entries, header['algorithm'], header.get('source', ''), new_image_path)
+    os.remove(manifest_path)
+
+
+def retier_image(image_path, new_image_path, profile_name, dry_run=False):
+    profile = validate_profile(profile_name)
+    print(f"\nRetiering {image_path} -> {new_image_path} ({profile_name})")
+
+    if (dry_run):
+        return None
+
+    # Written next to the final image (same filesystem), so it can be renamed into place atomically
+    tmp_image_path = join(os.path.dirname(new_image_path), retier_tmp_prefix + os.path.basename(new_image_path))
+
+    try:
+        if (image_path.endswith(TarZstdBackend.extension)):
+            is_created = recompress_tar_image(image_path, tmp_image_path, profile)
+            is_valid = is_created and TarZstdBackend().verify(tmp_image_path)
+        else:
+            is_created = rebuild_squashfs_image(image_path, tmp_image_path, profile)
+            is_valid = is_created and exists(tmp_image_path) and verify_squashfs(tmp_image_path)
+
+        # The old image is removed afterwards, so the new one has to contain every entry of it, not just be readable
+        is_valid = is_valid and listings_match(image_path, tmp_image_path)
+
+        if (not is_valid):
+            print(f"Recompressed image of {image_path} is not valid, keeping the original image")
+            return None
+
+        old_size = os.stat(image_path).st_size
+        new_size = os.stat(tmp_image_path).st_size
+
+        os.replace(tmp_image_path, new_image_path)
+        update_manifest(image_path, new_image_path)
+        os.remove(image_path)
+    finally:
+        if (exists(tmp_image_path)):
+            os.remove(tmp_image_path)
+
+    print(f"Size {round(old_size / pow(10, 6))}MB -> {round(new_size / pow(10, 6))}MB")
+
+    return new_image_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompress images older than a minimum age with a stronger compression profile while the machine is idle"
+    )
+
+    parser.add_argument('-dry', '--dry_run', action="store_true", help="Do not commit any changes to the system, only print what would be changed")
+    parser.add_argument('-b', '--backups_dir', '--target_dir', help="The directory containing the images", default="/backups")
+    parser.add_argument('-a', '--min_age_days', type=float, help="Only images older than this many days are recompressed", default=7)
+    parser.add_argument('-p', '--profile', choices=retier_profiles.keys(), help="Compression profile for the recompressed images", default='zstd22')
+    parser.add_argument('-sp', '--system_profile', choices=retier_profiles.keys(), help="Compression profile for images of the system targets", default='xz_x86')
+    parser.add_argument('-l', '--max_load', type=float, help="Maximum load average per cpu at which the machine is considered idle", default=0.3)
+    parser.add_argument('-w', '--max_wait_minutes', type=float, help="How long to wait for the machine to become idle before stopping", default=60)
+
+    args = parser.parse_args()
+
+    if (not isdir(args.backups_dir)):
+        raise Exception(f"Backups dir {args.backups_dir} does not exist or is not a directory")
+
+    candidates = find_retier_candidates(args.backups_dir, args.min_age_days, args.profile, args.system_profile)
+    print(f"{len(candidates)} images to recompress")
+
+    for image_path, new_image_path, profile_name in candidates:
+        if (not args.dry_run and not wait_until_idle(args.max_load, args.max_wait_minutes * 60)):
+            print("Machine did not become idle, stopping")
+            return 1
+
+        try:
+            retier_image(image_path, new_image_path, profile_name, dry_run=args.dry_run)
+        except Exception as err:
+            print(f"Retiering of {image_path} failed: {err}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
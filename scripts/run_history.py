@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import exists, join
+import argparse
+import json
+import shutil
+import statistics
+import sys
+import time
+from benchmark_mksquashfs import pretty_table, ugly_print
+
+# Records every completed backup run (one json object per line) and predicts duration and image size of the next run
+# Throughput and compression ratio are taken from previous runs of the same target with the same settings
+# and applied to the current size of the source, so growth or shrinking of the source since the last run is accounted for
+
+history_file_name = '.backup_history.jsonl'
+
+# Number of previous runs the prediction is based on (median, so single outliers do not matter)
+prediction_run_count = 5
+
+# Images are only started when the free space in the backups dir exceeds the predicted size by this factor
+free_space_margin = 1.1
+
+history_table_keys = ['target', 'settings', 'runs', 'input_GB', 'output_GB', 'ratio', 'duration_min', 'MBps', 'last_run']
+
+
+def get_history_path(backups_dir):
+    return join(backups_dir, history_file_name)
+
+
+def get_host_load():
+    # 1 minute load average normalized by the number of cpus, so values of different hosts are comparable
+    return round(os.getloadavg()[0] / (os.cpu_count() or 1), 3)
+
+
+def load_run_history(history_path):
+    if (not exists(history_path)):
+        return []
+
+    runs = []
+    with open(history_path, 'r') as history_file:
+        for line in history_file:
+            line = line.strip()
+            if (len(line) <= 0):
+                continue
+            try:
+                runs.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Partially written line of an interrupted run
+                continue
+
+    return runs
+
+
+def record_run(history_path, run):
+    # Appending single lines keeps earlier records intact even if the process is killed while writing
+    with open(history_path, 'a') as history_file:
+        history_file.write(json.dumps(run) + "\n")
+
+
+def get_matching_runs(runs, target, settings):
+    # Runs without an output size (like streamed archives recorded by older versions) can not predict the image size
+    successful_runs = [run for run in runs if run.get('success') and run.get('input_bytes', 0) > 0 and run.get('output_bytes', 0) > 0 and run.get('duration_s', 0) > 0]
+
+    for matches in [
+        lambda run: run['target'] == target and run['settings'] == settings,
+        # Same settings on another target still gives a rough estimate of throughput and ratio
+        lambda run: run['settings'] == settings,
+    ]:
+        matching_runs = [run for run in successful_runs if matches(run)]
+        if (len(matching_runs) > 0):
+            return matching_runs[-prediction_run_count:], matching_runs[0]['target'] == target
+
+    return [], False
+
+
+def predict_run(runs, target, settings, input_bytes):
+    """Predicted duration and output size of a run, None if there are no comparable previous runs"""
+    matching_runs, same_target = get_matching_runs(runs, target, settings)
+
+    if (len(matching_runs) <= 0):
+        return None
+
+    throughput = statistics.median(run['input_bytes'] / run['duration_s'] for run in matching_runs)
+    ratio = statistics.median(run['output_bytes'] / run['input_bytes'] for run in matching_runs)
+
+    last_run = matching_runs[-1]
+
+    return {
+        'based_on_runs': len(matching_runs),
+        'same_target': same_target,
+        'input_bytes': input_bytes,
+        'input_change_bytes': input_bytes - last_run['input_bytes'] if same_target else None,
+        'duration_s': round(input_bytes / throughput),
+        'output_bytes': int(input_bytes * ratio),
+        'ratio': round(ratio, 3),
+        'throughput_bytes_per_s': int(throughput),
+    }
+
+
+def print_prediction(prediction):
+    if (not prediction):
+        print("No previous runs with these settings, can not predict duration and size")
+        return
+
+    print(f"\nPrediction based on {prediction['based_on_runs']} previous runs{'' if prediction['same_target'] else ' of other targets'}:")
+    print(f"Source size: {round(prediction['input_bytes'] / pow(10, 9), 2)}GB")
+    if (prediction['input_change_bytes'] is not None):
+        print(f"Change since last run: {round(prediction['input_change_bytes'] / pow(10, 6), 1)}MB")
+    print(f"Estimated duration: {round(prediction['duration_s'] / 60, 1)}min")
+    print(f"Estimated image size: {round(prediction['output_bytes'] / pow(10, 9), 2)}GB (ratio {prediction['ratio']})")
+
+
+def check_free_space(backups_dir, prediction):
+    if (not prediction):
+        return True
+
+    free_bytes = shutil.disk_usage(backups_dir).free
+    required_bytes = int(prediction['output_bytes'] * free_space_margin)
+
+    if (free_bytes < required_bytes):
+        print(f"Not enough free space in {backups_dir}: {round(free_bytes / pow(10, 9), 2)}GB free, {round(required_bytes / pow(10, 9), 2)}GB predicted")
+        # The ratio of other targets can be far off (already compressed media vs text), only the target's own runs are trusted to abort
+        if (not prediction['same_target']):
+            print("The prediction is based on runs of other targets, creating the image anyway")
+            return True
+        return False
+
+    return True
+
+
+def get_history_summary(runs):
+    summary = {}
+    for run in runs:
+        if (not run.get('success')):
+            continue
+        summary.setdefault((run['target'], run['settings']), []).append(run)
+
+    rows = []
+    for (target, settings), target_runs in sorted(summary.items()):
+        last_run = target_runs[-1]
+        rows.append({
+            'target': target,
+            'settings': settings,
+            'runs': len(target_runs),
+            'input_GB': round(last_run['input_bytes'] / pow(10, 9), 2),
+            'output_GB': round(last_run['output_bytes'] / pow(10, 9), 2),
+            'ratio': round(last_run['output_bytes'] / last_run['input_bytes'], 3) if last_run['input_bytes'] > 0 else None,
+            'duration_min': round(last_run['duration_s'] / 60, 1),
+            'MBps': round(last_run['input_bytes'] / pow(10, 6) / last_run['duration_s'], 1) if last_run['duration_s'] > 0 else None,
+            'last_run': time.strftime('%Y-%m-%d %H:%M', time.localtime(last_run['timestamp'])),
+        })
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the recorded backup runs of each target and setting"
+    )
+
+    parser.add_argument('-b', '--backups_dir', '--target_dir', help="The directory containing the images and the run history", default="/backups")
+
+    args = parser.parse_args()
+
+    rows = get_history_summary(load_run_history(get_history_path(args.backups_dir)))
+
+    try:
+        pretty_table(rows, history_table_keys)
+    except ImportError:
+        ugly_print(rows, history_table_keys)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+import os
+from os.path import isfile, exists, join
+import argparse
+import fcntl
+import hashlib
+import json
+import re
+import sys
+import time
+from contextlib import contextmanager
+from backup_metrics import timed_phase
+
+# target_dir = "/backups"
+mount_images_dir = '/mnt'
+
+# Note that this does not work with the mksquashfs '-nopad' option, as the resulting image is not mountable
+def mount_squashfs_image(image_path, label, run_metrics=None, show_usage=True):
+
+    if (not exists(image_path)):
+        raise Exception(f"Can not mount image to system, image at path '{image_path}' does not exist")
+
+    if (os.stat(image_path).st_size <= 0):
+        raise Exception(f"Can not mount image to system, image at path '{image_path}' is empty")
+
+    if (not label or len(label) <= 0):
+        raise Exception(f"Label of mount point has to be non empty")
+
+    mount_dir = join(mount_images_dir, label)
+    # os.makedirs(mount_dir)
+    # os.system(f"sudo mkdir -p {mount_dir} && sudo umount -l {mount_dir} && sudo mount {image_path} {mount_dir}")
+
+    print(f"sudo mount {image_path} {mount_dir}")
+    with timed_phase(run_metrics, 'mount'):
+        os.system(f"sudo mkdir -p {mount_dir} && sudo mount {image_path} {mount_dir}")
+
+    record_mount_owner(label)
+
+    if (show_usage):
+        with timed_phase(run_metrics, 'du'):
+            os.system(f"du -h -d 1 {mount_dir}")
+
+    return mount_dir
+
+
+def umount_mount(mount_point, run_metrics=None):
+
+    if (not exists(mount_point)):
+        raise Exception(f"Can not unmount point at '{mount_point}' the path does not exist")
+
+    print(f"sudo umount -l {mount_point}")
+    with timed_phase(run_metrics, 'unmount'):
+        os.system(f"sudo umount -l {mount_point}")
+        os.system(f"sudo rm -d {mount_point}")
+
+    remove_mount_owner(os.path.basename(mount_point))
+
+
+def umount_labeled(mount_label):
+    mount_dir = join(mount_images_dir, mount_label)
+    umount_mount(mount_dir)
+
+
+def dir_tree_has_files(directory):
+    if (not directory or not exists(directory)):
+        return False
+
+    print("\nFiles in image: ")
+    print("\n".join(os.listdir(directory)))
+    print("\n")
+
+    for file in os.scandir(directory):
+        if (isfile(file)):
+            return True
+
+    return False
+
+
+def verify_squashfs(image_path, run_metrics=None):
+
+    import uuid
+    random_uuid_string = str(uuid.uuid4())
+    print(random_uuid_string)
+
+    try:
+        mounted_dir_path = mount_squashfs_image(image_path, random_uuid_string, run_metrics)
+
+        has_files = dir_tree_has_files(mounted_dir_path)
+
+        if (os.stat(image_path).st_size >= 0):
+            file_size = str(int(os.stat(image_path).st_size / pow(10, 3)))
+            print(f"The image has a file size of {file_size}kB")
+
+    except Exception as err:
+        umount_mount(mounted_dir_path, run_metrics)
+        raise err
+
+    umount_mount(mounted_dir_path, run_metrics)
+
+    return has_files
+
+
+# Mount pool: keeps images mounted between calls, so opening the same image again does not pay the mount cost
+# The active mounts are tracked in a state file in /run (cleared on reboot like the mounts themselves)
+# Mounts above the limit are unmounted least recently used first, except the ones a running process holds a lease on
+#
+# There is only one state for all users, otherwise a second state would not know the mounts of the first and see them as orphans.
+# Mounting needs root anyway, so the pool is only used by root (sudo)
+
+mount_pool_state_dir = '/run'
+mount_pool_state_name = 'squash_mount_pool.json'
+mount_pool_label_prefix = 'squashpool-'
+# Files named by mount label, containing the pid of the process that mounted it
+mount_owners_dir_name = 'squash_mount_owners'
+default_max_pool_mounts = 4
+
+uuid_label_regex = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+def get_mount_pool_state_path():
+    if (not os.access(mount_pool_state_dir, os.W_OK)):
+        raise PermissionError(f"The mount pool state in {mount_pool_state_dir} is not writable, the mount pool has to be used as root")
+
+    return join(mount_pool_state_dir, mount_pool_state_name)
+
+
+@contextmanager
+def locked_mount_pool_state(state_path=None):
+    """Loads the pool state under an exclusive lock and saves it when leaving the context"""
+    state_path = state_path or get_mount_pool_state_path()
+
+    with open(state_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        state = {}
+        if (exists(state_path)):
+            try:
+                with open(state_path, 'r') as state_file:
+                    state = json.load(state_file)
+            except json.JSONDecodeError:
+                state = {}
+
+        yield state
+
+        tmp_state_path = state_path + '.tmp'
+        with open(tmp_state_path, 'w') as state_file:
+            json.dump(state, state_file, indent=4)
+        os.replace(tmp_state_path, state_path)
+
+
+def get_mount_owners_dir():
+    return join(os.path.dirname(get_mount_pool_state_path()), mount_owners_dir_name)
+
+
+def get_process_start_time(pid):
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as stat_file:
+            stat_text = stat_file.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+    # Field 22 (starttime), counted from field 3 after the command name, see 'man 5 proc'
+    return int(stat_text[stat_text.rfind(')') + 2:].split()[19])
+
+
+def get_process_identity(pid=None):
+    pid = pid or os.getpid()
+    # The start time tells a reused pid apart from the original process
+    return {'pid': pid, 'start_time': get_process_start_time(pid)}
+
+
+def is_process_identity_alive(identity):
+    return get_process_start_time(identity['pid']) == identity['start_time']
+
+
+def record_mount_owner(label, pid=None):
+    """Records the process that mounted a label, so cleanup only removes mounts of processes that are gone"""
+    pid = pid or os.getpid()
+    try:
+        os.makedirs(get_mount_owners_dir(), exist_ok=True)
+        with open(join(get_mount_owners_dir(), label), 'w') as owner_file:
+            json.dump(get_process_identity(pid), owner_file)
+    except OSError as err:
+        print(f"Can not record the owner of mount {label}: {err}")
+
+
+def remove_mount_owner(label):
+    try:
+        os.remove(join(get_mount_owners_dir(), label))
+    except OSError:
+        pass
+
+
+def is_mount_owner_alive(label):
+    """Whether the process that mounted the label is still running, None if the owner is unknown"""
+    try:
+        with open(join(get_mount_owners_dir(), label), 'r') as owner_file:
+            owner = json.load(owner_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    return is_process_identity_alive(owner)
+
+
+def decode_mountinfo_path(path):
+    # Spaces, tabs, newlines and backslashes are escaped as octal in /proc/self/mountinfo
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+
+def get_active_mounts():
+    """Mount point -> (filesystem type, source) of all current mounts"""
+    active_mounts = {}
+    with open('/proc/self/mountinfo', 'r') as mountinfo_file:
+        for line in mountinfo_file:
+            fields, _, fs_fields = line.partition(' - ')
+            fs_fields = fs_fields.split()
+            mount_point = decode_mountinfo_path(fields.split()[4])
+            active_mounts[mount_point] = (fs_fields[0], decode_mountinfo_path(fs_fields[1]) if len(fs_fields) > 1 else None)
+
+    return active_mounts
+
+
+def get_pool_label(image_path):
+    # Stable per image, so a mount left by a killed process is found again
+    path_hash = hashlib.blake2b(os.path.abspath(image_path).encode(), digest_size=4).hexdigest()
+    return mount_pool_label_prefix + os.path.basename(image_path).split('.')[0][:48] + '-' + path_hash
+
+
+def get_image_identity(image_path):
+    image_stat = os.stat(image_path)
+    return [image_stat.st_ino, image_stat.st_size, image_stat.st_mtime_ns]
+
+
+def cleanup_orphan_mounts(state):
+    """Removes pool entries that are no longer mounted, and unmounts squashfs mounts left behind by killed processes"""
+    active_mounts = get_active_mounts()
+
+    for image_path, pool_mount in list(state.items()):
+        if (pool_mount['mount_dir'] not in active_mounts):
+            print(f"Removing stale pool entry of {image_path}")
+            del state[image_path]
+            if (exists(pool_mount['mount_dir'])):
+                os.system(f"sudo rm -d '{pool_mount['mount_dir']}'")
+
+    pool_mount_dirs = [pool_mount['mount_dir'] for pool_mount in state.values()]
+
+    for mount_point, (fs_type, source) in active_mounts.items():
+        if (fs_type != 'squashfs' or os.path.dirname(mount_point) != mount_images_dir):
+            continue
+
+        label = os.path.basename(mount_point)
+
+        if (label.startswith(mount_pool_label_prefix)):
+            # Pool mounts are only created while holding the state lock, one missing in the state was left by a killed process
+            if (mount_point in pool_mount_dirs):
+                continue
+        elif (uuid_label_regex.match(label)):
+            # Mounts of verify_squashfs can belong to a backup or verification running right now,
+            # they are only orphans once their owner is gone (mounts without a recorded owner are left alone)
+            if (is_mount_owner_alive(label) is not False):
+                continue
+        else:
+            # Never mounts created by hand
+            continue
+
+        print(f"Unmounting orphaned mount {mount_point} of {source}")
+        umount_mount(mount_point)
+
+
+def get_live_holders(pool_mount):
+    """Leases of the processes that still use the mount, the leases of processes that are gone are dropped"""
+    pool_mount['holders'] = [holder for holder in pool_mount.get('holders', []) if is_process_identity_alive(holder)]
+    return pool_mount['holders']
+
+
+def evict_pool_mounts(state, max_mounts):
+    # Mounts in use by a running process are never evicted, even if the pool stays above the limit
+    least_recently_used = sorted([item for item in state.items() if not get_live_holders(item[1])], key=lambda item: item[1]['last_used'])
+    mount_count = len(state)
+
+    while (mount_count > max_mounts and least_recently_used):
+        image_path, pool_mount = least_recently_used.pop(0)
+        print(f"Evicting pool mount of {image_path}")
+        if (exists(pool_mount['mount_dir'])):
+            umount_mount(pool_mount['mount_dir'])
+        del state[image_path]
+        mount_count -= 1
+
+    if (mount_count > max_mounts):
+        print(f"{mount_count} images stay mounted by the pool (limit {max_mounts}), the others are in use")
+
+
+def add_pool_lease(pool_mount):
+    holder = get_process_identity()
+    if (holder not in get_live_holders(pool_mount)):
+        pool_mount['holders'].append(holder)
+
+
+cleaned_up_pool_states = set()
+
+
+def acquire_pool_mount(image_path, max_mounts=default_max_pool_mounts, run_metrics=None):
+    """Mount directory of the image, reusing an existing mount of the pool if the image did not change since it was mounted"""
+    image_path = os.path.abspath(image_path)
+    state_path = get_mount_pool_state_path()
+
+    with locked_mount_pool_state(state_path) as state:
+        # Orphans are only searched once per process, reading the mount table on every access costs more than it saves
+        if (state_path not in cleaned_up_pool_states):
+            cleanup_orphan_mounts(state)
+            cleaned_up_pool_states.add(state_path)
+
+        pool_mount = state.get(image_path)
+        if (pool_mount and pool_mount['identity'] == get_image_identity(image_path) and os.path.ismount(pool_mount['mount_dir'])):
+            pool_mount['last_used'] = time.time()
+            add_pool_lease(pool_mount)
+            return pool_mount['mount_dir']
+
+        if (pool_mount):
+            # Image was replaced (for example by retiering) or unmounted by hand, the holders still read the old image through their open files
+            if (os.path.ismount(pool_mount['mount_dir'])):
+                umount_mount(pool_mount['mount_dir'])
+            del state[image_path]
+
+        mount_dir = mount_squashfs_image(image_path, get_pool_label(image_path), run_metrics, show_usage=False)
+        if (not os.path.ismount(mount_dir)):
+            raise Exception(f"Mounting {image_path} to {mount_dir} failed")
+
+        state[image_path] = {
+            'mount_dir': mount_dir,
+            'identity': get_image_identity(image_path),
+            'mounted_at': time.time(),
+            'last_used': time.time(),
+            'holders': [],
+        }
+        add_pool_lease(state[image_path])
+
+        evict_pool_mounts(state, max_mounts)
+
+    return mount_dir
+
+
+def release_pool_lease(image_path):
+    """Ends the lease of this process on the pool mount of the image, the image stays mounted for the next use"""
+    image_path = os.path.abspath(image_path)
+    holder = get_process_identity()
+
+    with locked_mount_pool_state() as state:
+        pool_mount = state.get(image_path)
+        if (pool_mount):
+            pool_mount['holders'] = [live_holder for live_holder in get_live_holders(pool_mount) if live_holder != holder]
+
+
+def unmount_pool_entry(state, image_path):
+    pool_mount = state[image_path]
+    holders = get_live_holders(pool_mount)
+    if (holders):
+        print(f"Not unmounting {image_path}, it is in use by the processes {', '.join(str(holder['pid']) for holder in holders)}")
+        return
+
+    if (exists(pool_mount['mount_dir'])):
+        umount_mount(pool_mount['mount_dir'])
+    del state[image_path]
+
+
+def release_pool_mount(image_path):
+    """Unmounts the image if it is mounted by the pool and no running process holds a lease on it"""
+    image_path = os.path.abspath(image_path)
+
+    with locked_mount_pool_state() as state:
+        if (image_path in state):
+            unmount_pool_entry(state, image_path)
+
+
+def release_all_pool_mounts():
+    with locked_mount_pool_state() as state:
+        for image_path in list(state.keys()):
+            unmount_pool_entry(state, image_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mount squashfs images through the mount pool, which reuses existing mounts and unmounts the least recently used ones"
+    )
+
+    parser.add_argument('action', choices=['mount', 'umount', 'list', 'cleanup'], help="mount/umount an image, list the pool mounts or clean up orphaned mounts")
+    parser.add_argument('image_paths', nargs='*', help="Images to mount or unmount (umount without images unmounts all pool mounts)")
+    parser.add_argument('-m', '--max_mounts', type=int, help="Maximum number of images kept mounted by the pool", default=default_max_pool_mounts)
+
+    args = parser.parse_args()
+
+    if (args.action == 'mount'):
+        for image_path in args.image_paths:
+            print(acquire_pool_mount(image_path, max_mounts=args.max_mounts))
+
+    elif (args.action == 'umount'):
+        if (len(args.image_paths) <= 0):
+            release_all_pool_mounts()
+        for image_path in args.image_paths:
+            release_pool_mount(image_path)
+
+    elif (args.action == 'cleanup'):
+        with locked_mount_pool_state() as state:
+            cleanup_orphan_mounts(state)
+            evict_pool_mounts(state, args.max_mounts)
+
+    with locked_mount_pool_state() as state:
+        for image_path, pool_mount in sorted(state.items(), key=lambda item: item[1]['last_used'], reverse=True):
+            print(f"{pool_mount['mount_dir']}\t{image_path}\tlast used {time.strftime('%Y-%m-%d %H:%M', time.localtime(pool_mount['last_used']))}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
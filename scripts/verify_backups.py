@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import os
+from os.path import exists, isdir, join
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from archive_backends import archive_backends, get_backend_for_image
+from backup_metrics import get_process_tree_read_position
+from checksum_manifest import hash_file, read_manifest, get_manifest_path, new_hasher
+from benchmark_mksquashfs import pretty_table, ugly_print
+from squashfs_mount import mount_squashfs_image, umount_mount
+
+# Verifies all images in the backups directory concurrently
+# Images that have a checksum manifest (created with --checksum_manifest) are checked by hashing the whole image,
+# which detects bit rot without mounting, all other images are fully read and decompressed (sqfs2tar, a mount or zstd)
+# Results are cached per image, unchanged images are only verified again after the recheck interval passed
+
+verify_cache_file_name = '.verify_cache.json'
+
+sample_count = 16
+sample_size = 64 * 1024
+
+verify_table_keys = ['image', 'status', 'method', 'size_MB', 'duration_s', 'verified_at']
+
+
+class ReadThrottle():
+    """Limits the combined read rate of all verification workers (token bucket)"""
+
+    def __init__(self, max_bytes_per_second):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.lock = threading.Lock()
+        self.available = max_bytes_per_second
+        self.last_refill = time.monotonic()
+
+    def consume(self, byte_count):
+        if (not self.max_bytes_per_second):
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.max_bytes_per_second, self.available + (now - self.last_refill) * self.max_bytes_per_second)
+            self.last_refill = now
+            self.available -= byte_count
+            # The debt of all workers is in the bucket, so each one waits until its own bytes are covered
+            wait_s = -self.available / self.max_bytes_per_second if self.available < 0 else 0
+
+        # Outside of the lock, the other workers can take their share of the budget in the meantime
+        if (wait_s > 0):
+            time.sleep(wait_s)
+
+
+def find_backup_images(backups_dir):
+    extensions = tuple(set(backend_class.extension for backend_class in archive_backends.values()))
+
+    image_paths = []
+    for dir_entry in os.scandir(backups_dir):
+        if (dir_entry.is_file(follow_symlinks=False) and dir_entry.name.endswith(extensions)):
+            image_paths.append(dir_entry.path)
+
+    return sorted(image_paths)
+
+
+def get_sampled_checksum(image_path, image_size):
+    """Hashes a few evenly spaced blocks of the image, cheap enough to detect an image being replaced or rewritten"""
+    hasher = new_hasher('blake2b')
+    with open(image_path, 'rb') as image_file:
+        for sample_index in range(sample_count):
+            image_file.seek(int(max(0, image_size - sample_size) * sample_index / max(1, sample_count - 1)))
+            hasher.update(image_file.read(sample_size))
+
+    return hasher.hexdigest()
+
+
+def get_image_cache_key(image_path):
+    image_stat = os.stat(image_path)
+    return {
+        'inode': image_stat.st_ino,
+        'size': image_stat.st_size,
+        'mtime_ns': image_stat.st_mtime_ns,
+        'sampled_checksum': get_sampled_checksum(image_path, image_stat.st_size),
+    }
+
+
+def load_verify_cache(cache_path):
+    if (not exists(cache_path)):
+        return {}
+
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (json.JSONDecodeError, OSError) as err:
+        print(f"Ignoring unreadable verification cache {cache_path}: {err}")
+        return {}
+
+
+def save_verify_cache(cache_path, verify_cache):
+    tmp_cache_path = cache_path + '.tmp'
+    with open(tmp_cache_path, 'w') as cache_file:
+        json.dump(verify_cache, cache_file, indent=4)
+    os.replace(tmp_cache_path, cache_path)
+
+
+def is_cached_result_valid(cached_result, cache_key, recheck_interval_s):
+    if (not cached_result or cached_result.get('status') != 'ok'):
+        return False
+
+    if (cached_result.get('key') != cache_key):
+        return False
+
+    return time.time() - cached_result.get('verified_at', 0) < recheck_interval_s
+
+
+def verify_image_checksum(image_path, read_throttle=None):
+    manifest_header, _ = read_manifest(get_manifest_path(image_path))
+    algorithm = manifest_header.get('algorithm')
+    expected_digest = manifest_header.get(f"image_{algorithm}")
+
+    if (not expected_digest):
+        return None
+
+    return hash_file(image_path, algorithm, read_throttle) == expected_digest
+
+
+read_chunk_size = 1024 * 1024
+
+
+def read_tar_zstd_image(image_path, backend, read_throttle=None):
+    # zstd checks the checksums of all frames while decompressing, tar that all headers are readable
+    list_cmd = f"zstd -dc {' '.join(backend.get_zstd_options())} | tar --list --file=- > /dev/null"
+    print(list_cmd)
+    list_process = subprocess.Popen(['bash', '-o', 'pipefail', '-c', list_cmd], stdin=subprocess.PIPE)
+
+    try:
+        with open(image_path, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(read_chunk_size), b''):
+                if (read_throttle):
+                    read_throttle.consume(len(chunk))
+                list_process.stdin.write(chunk)
+    except BrokenPipeError:
+        # zstd stopped reading because of an error, reported by the return code
+        pass
+    finally:
+        list_process.stdin.close()
+
+    return list_process.wait() == 0
+
+
+def read_squashfs_image(image_path, read_throttle=None):
+    if (shutil.which('sqfs2tar')):
+        # Decompresses every data and metadata block of the image, the tar stream is discarded
+        print(f"sqfs2tar '{image_path}'")
+        tar_process = subprocess.Popen(['sqfs2tar', image_path], stdout=subprocess.PIPE)
+        read_position = 0
+        for chunk in iter(lambda: tar_process.stdout.read(read_chunk_size), b''):
+            if (not read_throttle):
+                continue
+
+            # The budget is for reading the images, sqfs2tar is throttled by how much of the image it read (rchar),
+            # not by its decompressed output. Its pipe is only drained as fast as the budget allows, which also holds back its reads
+            tar_read_position = get_process_tree_read_position(tar_process.pid)
+            if (tar_read_position is None):
+                # io counters not readable, the output is at least as large as the image, so this throttles more than needed
+                read_throttle.consume(len(chunk))
+            elif (tar_read_position > read_position):
+                read_throttle.consume(tar_read_position - read_position)
+                read_position = tar_read_position
+        tar_process.stdout.close()
+
+        return tar_process.wait() == 0
+
+    # Without squashfs-tools-ng every file is read through a mount, a block that can not be decompressed is an io error.
+    # The throttle counts the decompressed file contents here, which is more than is read from the image
+    mount_dir = mount_squashfs_image(image_path, str(uuid.uuid4()), show_usage=False)
+
+    def raise_walk_error(err):
+        raise err
+
+    try:
+        for dir_path, _, file_names in os.walk(mount_dir, onerror=raise_walk_error):
+            for file_name in file_names:
+                file_path = join(dir_path, file_name)
+                if (not os.path.islink(file_path) and os.path.isfile(file_path)):
+                    hash_file(file_path, 'blake2b', read_throttle)
+    except PermissionError:
+        # Not a problem of the image, reported as 'error' instead of 'failed'
+        raise
+    except OSError as err:
+        print(f"Reading {image_path} failed: {err}")
+        return False
+    finally:
+        umount_mount(mount_dir)
+
+    return True
+
+
+def read_full_image(image_path, read_throttle=None):
+    """Reads and decompresses the whole image without writing anything, detects bit rot of images without a manifest"""
+    backend = get_backend_for_image(image_path)
+
+    if (os.stat(image_path).st_size <= 0):
+        return False
+
+    if (backend.name == 'tar_zstd'):
+        return read_tar_zstd_image(image_path, backend, read_throttle)
+
+    return read_squashfs_image(image_path, read_throttle)
+
+
+def verify_image(image_path, read_throttle=None):
+    start_time = time.monotonic()
+    method = 'full_read'
+
+    try:
+        is_valid = None
+        if (exists(get_manifest_path(image_path))):
+            is_valid = verify_image_checksum(image_path, read_throttle)
+            method = 'checksum'
+
+        if (is_valid is None):
+            # Mounting and listing the root (the check after creating an image) reads almost nothing of the image
+            method = 'full_read'
+            is_valid = read_full_image(image_path, read_throttle)
+
+        status = 'ok' if is_valid else 'failed'
+    except Exception as err:
+        print(f"Verification of {image_path} raised an error: {err}")
+        status = 'error'
+
+    return {
+        'status': status,
+        'method': method,
+        'duration_s': round(time.monotonic() - start_time, 2),
+        'verified_at': time.time(),
+    }
+
+
+def verify_backups_dir(backups_dir, jobs=2, max_read_mbps=None, recheck_days=7, force=False):
+    cache_path = join(backups_dir, verify_cache_file_name)
+    verify_cache = load_verify_cache(cache_path)
+    cache_lock = threading.Lock()
+    read_throttle = ReadThrottle(max_read_mbps * pow(10, 6)) if max_read_mbps else None
+    recheck_interval_s = recheck_days * 24 * 60 * 60
+
+    def process_image(image_path):
+        try:
+            cache_key = get_image_cache_key(image_path)
+        except OSError as err:
+            # Image was removed or replaced (retiering) while the other images were verified
+            print(f"Can not read {image_path}: {err}")
+            return {'image': os.path.basename(image_path), 'path': image_path, 'status': 'error', 'method': None, 'size_MB': None, 'duration_s': 0, 'verified_at': time.time()}
+
+        cached_result = verify_cache.get(image_path)
+
+        if (not force and is_cached_result_valid(cached_result, cache_key, recheck_interval_s)):
+            result = dict(cached_result)
+            result['status'] = 'cached'
+            return result
+
+        result = verify_image(image_path, read_throttle)
+        result['key'] = cache_key
+        result['image'] = os.path.basename(image_path)
+        result['path'] = image_path
+        result['size_MB'] = round(cache_key['size'] / pow(10, 6), 1)
+
+        with cache_lock:
+            verify_cache[image_path] = result
+            # Saved after every image, so an interrupted run does not lose the progress
+            save_verify_cache(cache_path, verify_cache)
+
+        return result
+
+    image_paths = find_backup_images(backups_dir)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(process_image, image_paths))
+
+    # Drop results of images that were removed
+    with cache_lock:
+        for cached_image_path in list(verify_cache.keys()):
+            if (cached_image_path not in image_paths):
+                del verify_cache[cached_image_path]
+        save_verify_cache(cache_path, verify_cache)
+
+    return results
+
+
+def print_verify_summary(results):
+    table_rows = []
+    for result in results:
+        table_row = dict(result)
+        table_row['verified_at'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(result['verified_at']))
+        table_rows.append(table_row)
+
+    try:
+        pretty_table(table_rows, verify_table_keys)
+    except ImportError:
+        ugly_print(table_rows, verify_table_keys)
+
+    status_counts = {}
+    for result in results:
+        status_counts[result['status']] = status_counts.get(result['status'], 0) + 1
+
+    print(", ".join(f"{status}: {count}" for status, count in sorted(status_counts.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Verify all images in the backups directory, skipping unchanged images that were verified recently"
+    )
+
+    parser.add_argument('-b', '--backups_dir', '--target_dir', help="The directory containing the images to verify", default="/backups")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of images to verify concurrently", default=2)
+    parser.add_argument('-r', '--max_read_mbps', type=float, help="Maximum combined read rate in MB/s when hashing images (not applied to mount based verification)", default=None)
+    parser.add_argument('-d', '--recheck_days', type=float, help="Verify images again after this many days, even if they did not change", default=7)
+    parser.add_argument('-fo', '--force', action="store_true", help="Ignore the cached results and verify all images")
+    parser.add_argument('-o', '--json_output', help="Path to write the verification results to as json", default=None)
+
+    args = parser.parse_args()
+
+    if (not isdir(args.backups_dir)):
+        raise Exception(f"Backups dir {args.backups_dir} does not exist or is not a directory")
+
+    results = verify_backups_dir(args.backups_dir, jobs=args.jobs, max_read_mbps=args.max_read_mbps, recheck_days=args.recheck_days, force=args.force)
+
+    print_verify_summary(results)
+
+    if (args.json_output):
+        with open(args.json_output, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+
+    if (any(result['status'] in ['failed', 'error'] for result in results)):
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
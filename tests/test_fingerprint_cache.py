@@ -0,0 +1,74 @@
+import os
+from os.path import dirname, join
+import sys
+
+sys.path.insert(0, join(dirname(dirname(os.path.abspath(__file__))), 'scripts'))
+
+from fingerprint_cache import get_fingerprint_cache_path, get_source_fingerprint, save_fingerprint_cache, set_last_image, get_unchanged_image, get_nested_dir_excludes, get_cached_source_size  # noqa: E402
+from run_history import get_history_path  # noqa: E402
+
+
+def write_file(path, content):
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as written_file:
+        written_file.write(content)
+
+
+def create_source(tmp_path):
+    source_dir = str(tmp_path / 'source')
+    write_file(join(source_dir, 'etc', 'hosts'), "127.0.0.1 localhost\n")
+    write_file(join(source_dir, 'home', 'user', 'notes.txt'), "notes\n")
+    return source_dir
+
+
+def test_nested_backups_dir_does_not_change_the_fingerprint(tmp_path):
+    source_dir = create_source(tmp_path)
+    backups_dir = join(source_dir, 'backups')
+    metrics_dir = join(source_dir, 'var', 'metrics')
+    os.makedirs(backups_dir)
+    os.makedirs(metrics_dir)
+
+    excludes = get_nested_dir_excludes(source_dir, [backups_dir, metrics_dir, None])
+    assert excludes == ['backups', 'var/metrics']
+
+    cache_path = get_fingerprint_cache_path(backups_dir, 'system')
+    root_fingerprint, _, _, fingerprint_cache = get_source_fingerprint(cache_path, source_dir, excludes, 'settings')
+    set_last_image(fingerprint_cache, root_fingerprint, join(backups_dir, 'system-2026-10-19.squash.img'))
+    write_file(fingerprint_cache['last_image']['path'], "image")
+    save_fingerprint_cache(cache_path, fingerprint_cache)
+
+    # Bookkeeping of the run, written after the scan
+    write_file(get_history_path(backups_dir), "{}\n")
+    write_file(join(backups_dir, 'system-2026-10-19.squash.img.manifest'), "manifest\n")
+    write_file(join(metrics_dir, 'system-2026-10-19.metrics.json'), "{}\n")
+
+    next_fingerprint, _, _, next_cache = get_source_fingerprint(cache_path, source_dir, excludes, 'settings')
+    assert next_fingerprint == root_fingerprint
+    assert get_unchanged_image(next_cache, next_fingerprint) == fingerprint_cache['last_image']['path']
+
+    write_file(join(source_dir, 'home', 'user', 'todo.txt'), "todo\n")
+    changed_fingerprint, _, _, _ = get_source_fingerprint(cache_path, source_dir, excludes, 'settings')
+    assert changed_fingerprint != root_fingerprint
+
+
+def test_backups_dir_outside_or_equal_to_the_source(tmp_path):
+    source_dir = create_source(tmp_path)
+
+    assert get_nested_dir_excludes(source_dir, [str(tmp_path / 'backups'), str(tmp_path / 'source-backups')]) == []
+    assert get_nested_dir_excludes(source_dir, [source_dir]) == ['.fingerprints', '.backup_history.jsonl']
+
+
+def test_cached_source_size(tmp_path):
+    source_dir = create_source(tmp_path)
+    cache_path = get_fingerprint_cache_path(str(tmp_path / 'backups'), 'source')
+
+    assert get_cached_source_size(cache_path, source_dir, [], 'settings') == (26, 2)
+
+    _, source_size, file_count, fingerprint_cache = get_source_fingerprint(cache_path, source_dir, [], 'settings')
+    save_fingerprint_cache(cache_path, fingerprint_cache)
+    assert (source_size, file_count) == (26, 2)
+
+    # New file in a sub directory of an unchanged directory
+    write_file(join(source_dir, 'home', 'user', 'todo.txt'), "todo\n")
+    assert get_cached_source_size(cache_path, source_dir, [], 'settings') == (31, 3)
+    assert get_cached_source_size(cache_path, source_dir, ['home'], 'settings') == (20, 1)